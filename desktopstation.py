@@ -8,125 +8,1317 @@ Date: 2023/12/24 初版
 # コマンドは以下のURLで公開されています。
 # https://desktopstation.net/wiki/doku.php/desktop_station_s_serial_communication_specification
 
-import time, serial, threading
+import time, array, queue, serial, bisect, asyncio, logging, threading, collections
+import logging.handlers
+from concurrent.futures import Future
+
+# 動作の記録は logging で出す。何も設定しなければ WARNING 以上だけが表示される。
+#   desktopstation          接続・切断やエラー
+#   desktopstation.serial   送受信したコマンドと応答 (DEBUG)
+#   desktopstation.s88      S88 の状態 (DEBUG) とポーリング
+log = logging.getLogger('desktopstation')
+serial_log = logging.getLogger('desktopstation.serial')
+s88_log = logging.getLogger('desktopstation.s88')
+
+_queue_listener = None
+_saved_log_state = None                 # enable_queue_logging の前の (level, propagate)
+
+# desktopstation のログを、キューを通して別スレッドで書き出すようにする。
+# 文字列の組み立てと画面・ファイルへの書き込みが、シリアルの送受信スレッドで行われなくなる。
+# handler を省略すると標準エラー出力に書く。
+def enable_queue_logging(handler = None, level = logging.INFO):
+    global _queue_listener, _saved_log_state
+    disable_queue_logging()
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+    q = queue.SimpleQueue()
+    _saved_log_state = (log.level, log.propagate)
+    log.addHandler(logging.handlers.QueueHandler(q))
+    log.setLevel(level)
+    log.propagate = False
+    _queue_listener = logging.handlers.QueueListener(q, handler, respect_handler_level = True)
+    _queue_listener.start()
+    return _queue_listener
+
+# enable_queue_logging の前の状態 (ハンドラ、レベル、propagate) に戻す。
+def disable_queue_logging():
+    global _queue_listener, _saved_log_state
+    if _queue_listener is None:
+        return
+    _queue_listener.stop()
+    _queue_listener = None
+    for h in [h for h in log.handlers if isinstance(h, logging.handlers.QueueHandler)]:
+        log.removeHandler(h)
+    log.setLevel(_saved_log_state[0])
+    log.propagate = _saved_log_state[1]
+    _saved_log_state = None
+
+# データ行を返すコマンドと、そのデータ行の先頭文字列。
+_REPLY_PREFIX = {'getS88': '@S88,', 'getLocoConfig': '@CV,'}
+
+# 最初の引数が機関車・ポイントのアドレスになっているコマンド。
+_ADDRESSED = {'setLocoSpeed', 'setLocoDirection', 'setLocoFunction', 'setLocoConfig', 'getLocoConfig', 'setTurnout'}
+
+# 状態を設定するコマンドと、状態のキーになる先頭の引数の数。(機関車・ポイントのアドレス, ファンクション番号)
+_STATE_KEY_ARGS = {'setLocoSpeed': 1, 'setLocoDirection': 1, 'setLocoFunction': 2, 'setTurnout': 1}
+
+# コマンドの種類。種類ごとに送信間隔を決める。ここに無いものは 'system'。
+_COMMAND_CLASS = {'setLocoSpeed': 'loco', 'setLocoDirection': 'loco', 'setLocoFunction': 'loco',
+                  'setTurnout': 'turnout', 'getS88': 's88', 'setLocoConfig': 'cv', 'getLocoConfig': 'cv'}
+
+# コマンドの種類ごとの送信間隔(200 Ok を受けてから次を送るまでの秒数)を決める。
+# 実際の応答時間を測っていて、adaptive なら応答時間 x margin が min_gap より長いときはそちらを使う。
+# min_gap を小さくすれば、応答時間から決まる間隔までは詰めて送れる。
+# reply_timeout は種類ごとの応答を待つ秒数。ここに無い種類は DesktopStation.reply_timeout を使う。
+# (サービスモードの CV の読み書きは 1 秒以上かかることがある)
+class Pacing:
+    MIN_GAP = {'loco': 0.1, 'turnout': 0.1, 's88': 0.01, 'cv': 0.1, 'system': 0.1}
+    REPLY_TIMEOUT = {'cv': 3.0}
+
+    def __init__(self, min_gap = None, margin = 2.0, adaptive = True, reply_timeout = None):
+        self.min_gap = dict(self.MIN_GAP)
+        if min_gap:
+            self.min_gap.update(min_gap)
+        self.reply_timeout = dict(self.REPLY_TIMEOUT)
+        if reply_timeout:
+            self.reply_timeout.update(reply_timeout)
+        self.margin = margin
+        self.adaptive = adaptive
+        self.gap = dict(self.min_gap)       # 今使っている間隔
+        self.ack_time = {}                  # 種類 -> 送信から 200 Ok までの時間 (指数移動平均)
+        self._lock = threading.Lock()
+
+    # 送信から 200 Ok までの時間を記録する。
+    def record_ack(self, cls, seconds):
+        with self._lock:
+            prev = self.ack_time.get(cls)
+            self.ack_time[cls] = seconds if prev is None else prev * 0.8 + seconds * 0.2
+            if self.adaptive:
+                self._update(cls)
+
+    # 測った応答時間から全種類の間隔を決め直す。決めた間隔を返す。
+    def calibrate(self):
+        with self._lock:
+            for cls in self.min_gap:
+                self._update(cls)
+            return dict(self.gap)
+
+    def _update(self, cls):
+        self.gap[cls] = max(self.min_gap.get(cls, 0.0), self.ack_time.get(cls, 0.0) * self.margin)
+
+    # このコマンドの後に置く間隔。lock_time を指定したコマンドはそれを使う。
+    def gap_for(self, cmd):
+        if cmd.lock_time is not None:
+            return cmd.lock_time
+        return self.gap.get(cmd.cls, self.gap['system'])
+
+# 時間のヒストグラム。バケットの上限(秒)ごとの件数と、合計・件数・最大を持つ。
+class Histogram:
+    BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)     # 最後は上限なし (+Inf)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'buckets': dict(zip([str(b) for b in self.BUCKETS] + ['+Inf'], self.counts))}
+
+# 動作中の計測値。ヒストグラムとカウンタを (名前, ラベル) ごとに持つ。
+# 記録は辞書の参照と足し算だけなので、送受信のスレッドから呼んでも負担にならない。
+class Metrics:
+    HELP = {
+        'command_call_to_write_seconds': "time from queueing a command to writing it to the port",
+        'command_write_to_ack_seconds': "time from writing a command to its 200 Ok",
+        's88_poll_period_seconds': "time between S88 snapshots while polling",
+        's88_poll_jitter_seconds': "difference between the S88 poll period and the polling interval",
+        's88_wait_seconds': "time waitForS88 callers stayed blocked",
+        's88_poll_overruns_total': "S88 polls skipped because the previous poll ran past its deadline",
+        'commands_total': "commands written to the port",
+        'reply_errors_total': "commands answered with an error or not answered (DS REPLY_ERROR)",
+        'reply_timeouts_total': "commands not answered within reply_timeout",
+        'commands_skipped_total': "commands not sent because the cached state already matched",
+        'commands_coalesced_total': "commands merged into a queued command for the same address",
+    }
+    # Prometheus でのラベルの名前。無いものはコマンドの種類 (class)。
+    LABELS = {
+        's88_poll_period_seconds': 'mode',      # poll (全装置) / watched (見られている装置)
+        's88_poll_jitter_seconds': 'mode',
+        's88_poll_overruns_total': 'mode',
+        's88_wait_seconds': 'outcome',          # arrived / timeout
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}            # (名前, ラベル) -> Histogram
+        self.counters = {}              # (名前, ラベル) -> 件数
+
+    def observe(self, name, label, value):
+        with self._lock:
+            h = self.histograms.get((name, label))
+            if h is None:
+                h = self.histograms[(name, label)] = Histogram()
+            h.observe(value)
+
+    def count(self, name, label, n = 1):
+        with self._lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    # {名前: {ラベル: 値}} の形で返す。
+    def snapshot(self):
+        result = {}
+        with self._lock:
+            for (name, label), h in self.histograms.items():
+                result.setdefault(name, {})[label] = h.snapshot()
+            for (name, label), n in self.counters.items():
+                result.setdefault(name, {})[label] = n
+        return result
+
+    # Prometheus のテキスト形式にする。gauges は {名前: 値} の追加の値。
+    def prometheus(self, gauges = None, prefix = 'desktopstation_'):
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP %s%s %s' % (prefix, name, self.HELP.get(name, name)))
+                lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+        for (name, label), h in histograms:
+            header(name, 'histogram')
+            key = self.LABELS.get(name, 'class')
+            total = 0
+            for bound, n in zip([str(b) for b in Histogram.BUCKETS] + ['+Inf'], h.counts):
+                total += n
+                lines.append('%s%s_bucket{%s="%s",le="%s"} %d' % (prefix, name, key, label, bound, total))
+            lines.append('%s%s_sum{%s="%s"} %f' % (prefix, name, key, label, h.sum))
+            lines.append('%s%s_count{%s="%s"} %d' % (prefix, name, key, label, h.count))
+        for (name, label), n in counters:
+            header(name, 'counter')
+            lines.append('%s%s{%s="%s"} %d' % (prefix, name, self.LABELS.get(name, 'class'), label, n))
+        for name, value in sorted((gauges or {}).items()):
+            header(name, 'gauge')
+            lines.append('%s%s %s' % (prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+# コマンドの優先度。小さいほど先に送る。
+PRIORITY_STOP = 0       # 停車 (速度 0)・電源断
+PRIORITY_SPEED = 1      # 機関車の速度・方向・ファンクション、その他
+PRIORITY_TURNOUT = 2    # ポイント
+PRIORITY_POLL = 3       # S88 の読み取り、CV の読み書き
+
+# コマンドの既定の優先度を決める。
+def _default_priority(name, args):
+    if name == 'setLocoSpeed' and args.split(',')[1:2] == ['0']:
+        return PRIORITY_STOP
+    if name == 'setPower' and args.rstrip(')') == '0':
+        return PRIORITY_STOP
+    if name == 'setTurnout':
+        return PRIORITY_TURNOUT
+    if name in ('getS88', 'getLocoConfig', 'setLocoConfig'):
+        return PRIORITY_POLL
+    return PRIORITY_SPEED
+
+# 受信した1行を解析した結果。text は受信した行そのもの。
+ReplyOk = collections.namedtuple('ReplyOk', 'text')                         # 200 Ok
+ReplyError = collections.namedtuple('ReplyError', 'code text')              # 200 以外の応答コード
+ReplyReady = collections.namedtuple('ReplyReady', 'text')                   # 起動時の 100 Ready
+ReplyS88 = collections.namedtuple('ReplyS88', 'words text')                 # @S88,xxxx,yyyy,...
+ReplyCV = collections.namedtuple('ReplyCV', 'addr num value text')          # @CV,アドレス,CV番号,値,
+ReplyData = collections.namedtuple('ReplyData', 'text')                     # その他の行
+
+_REPLY_OK = ReplyOk('200 Ok')
+_REPLY_READY = ReplyReady('100 Ready')
+
+# buf[start:end] の1行 (\r\n は含まない) を解析する。行を切り出さずに buf の中を直接見る。
+# 数にするところだけは int() のために小さく切り出す。
+def parse_reply(buf, start = 0, end = None):
+    if end is None:
+        end = len(buf)
+    n = end - start
+    if n == 6 and buf.startswith(b'200 Ok', start, end):     # ほとんどの応答はこれなので、文字列を作らない
+        return _REPLY_OK
+    if n == 9 and buf.startswith(b'100 Ready', start, end):
+        return _REPLY_READY
+    text = buf[start:end].decode(errors = 'replace')
+    if n >= 3 and 0x30 <= buf[start] <= 0x39 and 0x30 <= buf[start + 1] <= 0x39 and 0x30 <= buf[start + 2] <= 0x39:
+        code = int(buf[start:start + 3])
+        if code == 200:
+            return ReplyOk(text)
+        if code == 100:
+            return ReplyReady(text)
+        return ReplyError(code, text)
+    try:
+        if buf.startswith(b'@S88,', start, end):
+            return ReplyS88([int(w, 16) for w in buf[start + 5:end].split(b',') if w], text)
+        if buf.startswith(b'@CV,', start, end):
+            addr, num, value = buf[start + 4:end].split(b',')[:3]
+            return ReplyCV(int(addr), int(num), int(value), text)
+    except ValueError:
+        pass                            # 壊れたデータ行
+    return ReplyData(text)
+
+# 受信したデータを \r\n で行に区切って解析する。受信バッファは使い回し、
+# 行は切り出さずに位置で parse_reply に渡す。使い終わった分は feed の最後に1回だけ詰める。
+class ReplyParser:
+    def __init__(self):
+        self.buf = bytearray()
+        self._scan = 0                  # ここより前に \r\n は無い
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        replies = []
+        start = 0
+        while True:
+            end = buf.find(b'\r\n', max(start, self._scan - 1))
+            if end < 0:
+                break
+            if end > start:
+                replies.append(parse_reply(buf, start, end))
+            start = end + 2
+        if start:
+            del buf[:start]
+        self._scan = len(buf)
+        return replies
+
+    def clear(self):
+        del self.buf[:]
+        self._scan = 0
+
+# 応答の文字列。従来どおり '200 Ok' in rcv のように使えて、解析した結果も持っている。
+#   status  応答コードの行 (ReplyOk / ReplyError)。来なかったら None
+#   data    データ行 (ReplyS88 / ReplyCV など)。無ければ None
+class Reply(str):
+    status = None
+    data = None
+
+    @property
+    def ok(self):
+        return type(self.status) is ReplyOk
+
+# キューに積むコマンド1つ分。結果は future で受け取る。
+class _Command:
+    def __init__(self, command_str, lock_time, future = None, priority = None):
+        self.command_str = command_str
+        self.lock_time = lock_time
+        self.future = Future() if future is None else future
+        self.merged = []            # まとめられた古いコマンドの future。同じ応答で完了させる。
+        self.name, _, args = command_str.partition('(')
+        self.args = args.rstrip(')').split(',')
+        self.target = args.split(',', 1)[0] if self.name in _ADDRESSED else None    # 宛先のアドレス (文字列)
+        self.expect = _REPLY_PREFIX.get(self.name)                      # 待っているデータ行
+        self.cls = _COMMAND_CLASS.get(self.name, 'system')
+        self.priority = _default_priority(self.name, args) if priority is None else priority
+        self.queued_at = time.monotonic()
+        n = _STATE_KEY_ARGS.get(self.name)
+        self.state_key = (self.name,) + tuple(args.split(',')[:n]) if n else None    # 状態キャッシュのキー
+        self.lines = []             # このコマンドに割り当てた応答 (ReplyOk など) を受けた順に
+        self.status = None          # 応答コード (ReplyOk / ReplyError)
+        self.data = None            # データ行 (ReplyS88 / ReplyCV)
+        self.sent_at = 0.0
+        self.started = False
+
+    # 応答コードと(必要なら)データ行が揃ったら完了。
+    def complete(self):
+        if self.status is None:
+            return False
+        return self.expect is None or self.data is not None or type(self.status) is not ReplyOk
+
+    def ok(self):
+        return type(self.status) is ReplyOk
+
+    # データ行がこのコマンドの引数 (装置の数、アドレスと CV 番号) どおりか。
+    # 引数や行から確かめられないときは True。
+    def accepts(self, data):
+        try:
+            if type(data) is ReplyS88:
+                return len(data.words) == int(self.args[0])
+            if type(data) is ReplyCV:
+                return data.addr == int(self.args[0]) and data.num == int(self.args[1])
+        except (IndexError, ValueError):
+            pass
+        return True
+
+    def reply(self):
+        rcv = Reply(''.join(r.text + '\r\n' for r in self.lines))
+        rcv.status = self.status
+        rcv.data = self.data
+        return rcv
+
+    # 送信を始める。キャンセルされていない future が1つも無ければ False。
+    # 再接続で送り直すコマンドは、もう始めているのでそのまま送る。
+    def start(self):
+        if self.started:
+            return True
+        self.started = True
+        futures = [f for f in [self.future] + self.merged if f.set_running_or_notify_cancel()]
+        if not futures:
+            return False
+        self.future, self.merged = futures[0], futures[1:]
+        return True
+
+    # 再接続で送り直すときに、途中まで受けた応答を捨てる。
+    def rewind(self):
+        self.lines = []
+        self.status = None
+        self.data = None
+
+    def set_result(self, rcv):
+        for f in [self.future] + self.merged:
+            f.set_result(rcv)
+
+    def set_exception(self, e):
+        for f in [self.future] + self.merged:
+            f.set_exception(e)
+
+# 解析した1行を、それを待っているコマンドに割り当てて、そのコマンドを返す。
+# データ行(@S88, @CV 等)はそのデータを待つコマンドのうち、引数が合う一番古いものへ、
+# 応答コード行(200 Ok, エラー)は送った順に割り当てる。
+# 起動時の 100 Ready や、誰も待っていない行 (タイムアウトしたコマンドへの遅れた応答など) なら None。
+def _match_reply(inflight, reply):
+    kind = type(reply)
+    if kind is ReplyOk or kind is ReplyError:
+        for c in inflight:
+            if c.status is None:
+                c.lines.append(reply)
+                c.status = reply
+                return c
+    elif kind is not ReplyReady:
+        for c in inflight:
+            if c.expect is not None and c.data is None and reply.text.startswith(c.expect) and c.accepts(reply):
+                c.lines.append(reply)
+                c.data = reply
+                return c
+    return None
+
+# 完了済みの future を作る。(送信しなかった場合など)
+def _done_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+# future の結果を fn で変換した future を返す。
+def _chain_future(future, fn):
+    chained = Future()
+    def _done(f):
+        try:
+            chained.set_result(fn(f.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+    future.add_done_callback(_done)
+    return chained
+
+# waitForS88 の結果。到着したら真になるので、従来どおり if 文で使える。
+class S88WaitResult:
+    def __init__(self, count, num, arrived, elapsed, time = None):
+        self.count = count          # S88 装置の番号 (1始まり)
+        self.num = num              # ビットの番号 (1始まり)
+        self.arrived = arrived
+        self.elapsed = elapsed      # 待った秒数
+        self.time = time            # H を読んだ S88 の時刻 (time.monotonic)。タイムアウトしたら None
+
+    def __bool__(self):
+        return self.arrived
+
+    def __repr__(self):
+        return "S88WaitResult(count=%d, num=%d, arrived=%s, elapsed=%.3f)" % (self.count, self.num, self.arrived, self.elapsed)
+
+    def what(self):
+        return "S88-%d bit %d" % (self.count, self.num)
+
+# wait_any, wait_all, wait_sequence, wait_until の結果。条件が成り立ったら真になる。
+# value は成り立った条件 (wait_any ならHになったビット (装置番号, ビット番号)、wait_until なら predicate の戻り値)、
+# index は wait_any ならそのビットの bits での位置、wait_sequence なら進んだ段の数。
+# times は成り立った(wait_sequence では段ごとの) S88 を読んだ時刻 (time.monotonic)。
+class S88ConditionResult:
+    def __init__(self, kind, bits, fired, value, index, times, elapsed):
+        self.kind = kind
+        self.bits = bits
+        self.fired = fired
+        self.value = value
+        self.index = index
+        self.times = times
+        self.elapsed = elapsed      # 待った秒数
+
+    @property
+    def time(self):
+        return self.times[-1] if self.fired else None
+
+    def __bool__(self):
+        return self.fired
+
+    def __repr__(self):
+        return "S88ConditionResult(kind=%s, fired=%s, value=%r, index=%r, elapsed=%.3f)" % (
+            self.kind, self.fired, self.value, self.index, self.elapsed)
+
+    def what(self):
+        return "%s(%s)" % (self.kind, ", ".join("S88-%d bit %d" % b for b in self.bits))
+
+# waitForS88(..., raise_on_timeout = True) などでタイムアウトしたときの例外。
+class S88Timeout(TimeoutError):
+    def __init__(self, result):
+        super().__init__("%s not arrived in %.1f s" % (result.what(), result.elapsed))
+        self.result = result
+
+# ビットの指定を (装置番号, ビット番号) にする。数だけなら1番目の装置のビット。
+def _s88_bit(bit):
+    if isinstance(bit, int):
+        return (1, bit)
+    count, num = bit
+    return (count, num)
+
+# wait_any などの条件を、S88 装置ごとのビットマスクにしたもの。
+# S88 を読むたびに、読んだスレッドが check で1回だけ調べて、成り立ったら event で待っているスレッドを起こす。
+class _S88Condition:
+    def __init__(self, kind, steps = (), predicate = None, units = 1):
+        self.kind = kind                # 'any', 'all', 'sequence', 'until'
+        self.bits = [b for step in steps for b in step]
+        self.masks = []                 # 段ごとの [(装置の添字, マスク), ...]
+        for step in steps:
+            masks = {}
+            for count, num in step:
+                masks[count - 1] = masks.get(count - 1, 0) | (1 << (num - 1))
+            self.masks.append(sorted(masks.items()))
+        self.predicate = predicate
+        self.units = max([count for count, _ in self.bits], default = units)   # 読む必要がある装置の数
+        self.step = 0
+        self.times = []
+        self.value = None
+        self.index = None
+        self.error = None
+        self.fired = False
+        self.event = threading.Event()
+
+    # words は S88 の状態。成り立ったら True を返す。
+    def check(self, words, now):
+        if self.kind == 'any':
+            if not any(words[i] & m for i, m in self.masks[0]):
+                return False
+            for i, (count, num) in enumerate(self.bits):
+                if (words[count - 1] >> (num - 1)) & 1:
+                    self.value, self.index = (count, num), i
+                    break
+        elif self.kind == 'all':
+            if not all(words[i] & m == m for i, m in self.masks[0]):
+                return False
+            self.value = tuple(self.bits)
+        elif self.kind == 'sequence':
+            while self.step < len(self.masks) and all(words[i] & m == m for i, m in self.masks[self.step]):
+                self.times.append(now)
+                self.step += 1
+            self.index = self.step
+            if self.step < len(self.masks):
+                return False
+            self.value = self.bits[-1] if self.bits else None
+            return self._fire(None if self.bits else now)
+        else:
+            try:
+                self.value = self.predicate(words)
+            except Exception as e:      # 待っているスレッドで投げ直す
+                self.error = e
+                return self._fire(now)
+            if not self.value:
+                return False
+        return self._fire(now)
+
+    def _fire(self, now):
+        if now is not None:
+            self.times.append(now)
+        self.fired = self.error is None
+        return True
+
+# S88 のビットの変化 1つ分。time は time.monotonic() の時刻、value は変化後の値 (1 = H, 0 = L)。
+S88Edge = collections.namedtuple('S88Edge', 'time count num value')
+
+# S88 のビットの変化を、固定長の配列を輪にして記録するバッファ。
+# 書くのは S88 を更新するスレッドだけで、読む側はロックを取らずに自分の読み位置から読む。
+# 読むのが遅れて capacity 個以上追い越されたら、その分は捨てて lost に数える。
+class S88EdgeBuffer:
+    def __init__(self, capacity = 1024):
+        self.capacity = capacity
+        self._time = array.array('d', [0.0] * capacity)
+        self._count = array.array('H', [0] * capacity)
+        self._num = array.array('B', [0] * capacity)
+        self._value = array.array('B', [0] * capacity)
+        self.seq = 0                    # これまでに書いた数。次に書く位置は seq % capacity
+        self._cv = threading.Condition()
+        self._blocked = 0               # get() で眠っている読み手の数
+        self._async_waiters = set()     # (ループ, asyncio.Event)
+
+    # 2つの S88 の状態を比べて、変わったビットを書き込む。書いた数を返す。
+    def push_diff(self, t, old_words, new_words):
+        written = 0
+        for i, (old, new) in enumerate(zip(old_words, new_words)):
+            diff = old ^ new
+            bit = 0
+            while diff:
+                if diff & 1:
+                    idx = self.seq % self.capacity
+                    self._time[idx] = t
+                    self._count[idx] = i + 1
+                    self._num[idx] = bit + 1
+                    self._value[idx] = (new >> bit) & 1
+                    self.seq += 1       # 書き終わってから進めるので、読み手は書きかけを読まない
+                    written += 1
+                diff >>= 1
+                bit += 1
+        if written:
+            self._wake()
+        return written
+
+    def _wake(self):
+        if self._blocked:
+            with self._cv:
+                self._cv.notify_all()
+        for loop, event in list(self._async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    # pos 番目の記録を読む。追い越されていたら None。
+    def read(self, pos):
+        idx = pos % self.capacity
+        edge = S88Edge(self._time[idx], self._count[idx], self._num[idx], self._value[idx])
+        if self.seq - pos >= self.capacity:
+            return None                 # 読んでいる間に上書きされたか、今書いているところ
+        return edge
+
+    def subscribe(self):
+        return S88EdgeSubscription(self)
+
+# S88EdgeBuffer の読み手。作った時点より後の変化を、古い順に返す。
+#   for edge in sub: ...          変化が来るまで眠って待つ (sub.close() で終わる)
+#   async for edge in sub: ...    asyncio から待つ
+#   sub.poll()                    今ある分だけをリストで返す
+class S88EdgeSubscription:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.pos = buffer.seq
+        self.lost = 0                   # 追い越されて読めなかった数
+        self.closed = False
+
+    def poll(self):
+        edges = []
+        while self.pos < self.buffer.seq:
+            edge = self._take_one()
+            if edge is not None:
+                edges.append(edge)
+        return edges
+
+    # 次の変化を1つ返す。timeout 秒来なければ None。
+    def get(self, timeout = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.closed:
+            if self.pos < self.buffer.seq:
+                edge = self._take_one()
+                if edge is not None:
+                    return edge
+                continue
+            with self.buffer._cv:
+                self.buffer._blocked += 1
+                try:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self.buffer._cv.wait_for(lambda: self.pos < self.buffer.seq or self.closed, remaining)
+                finally:
+                    self.buffer._blocked -= 1
+        return None
+
+    # 読み位置の記録を1つ読んで進める。追い越されていたら読める所まで飛ばす。
+    # (seq - capacity の位置は書き手が次に書く場所なので、その次から読む)
+    def _take_one(self):
+        if self.buffer.seq - self.pos >= self.buffer.capacity:
+            skip = self.buffer.seq - self.buffer.capacity + 1 - self.pos
+            self.lost += skip
+            self.pos += skip
+        edge = self.buffer.read(self.pos)
+        if edge is not None:
+            self.pos += 1
+        return edge
+
+    def close(self):
+        self.closed = True
+        with self.buffer._cv:
+            self.buffer._cv.notify_all()
+        for loop, event in list(self.buffer._async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        edge = self.get()
+        if edge is None:
+            raise StopIteration
+        return edge
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        while not self.closed:
+            if self.pos < self.buffer.seq:
+                edge = self._take_one()
+                if edge is not None:
+                    return edge
+                continue
+            event.clear()
+            self.buffer._async_waiters.add(waiter)
+            try:
+                if self.pos >= self.buffer.seq and not self.closed:
+                    await event.wait()
+            finally:
+                self.buffer._async_waiters.discard(waiter)
+        raise StopAsyncIteration
 
 class DesktopStation:
     # s88_count は接続している S88 装置の数。1つで 8 または 16 port。
-    def __init__(self, s88_count = 1):
+    # pipeline は応答を待たずに送ってよいコマンドの数。1 なら 1つずつ応答を待ってから次を送る。
+    # 2 以上にすると、ウェイトを 200 Ok からではなく送信時刻から数えて、応答を待たずに次を送る。
+    # DS の「200 Ok を受けてから 100ms 以上置く」という決まりには従わないので、それで動く DS でだけ使うこと。
+    # pacing でコマンドの種類ごとの送信間隔を変えられる。(Pacing を参照)
+    def __init__(self, s88_count = 1, pipeline = 1, pacing = None):
         self.ser = serial.Serial()
         self.comm_ok = False         
-        self.lock = False
         self.polling_s88_en = False
+        self.polling_interval = 0.1
+        self.idle_interval = None               # 見られていない装置を読む間隔 (start_polling_s88 を参照)
+        self.heartbeat_interval = None
+        self.poll_overruns = 0                  # ポーリングが間に合わずに飛ばした回数
+        self._poll_thread = None
+        self._poll_wake = threading.Event()     # セットするとポーリングのスレッドがすぐに起きる (停止・見る装置の変化)
+        self._s88_watch = collections.Counter() # S88 装置番号 -> 見ている数 (watch_s88)
         self.s88b = [0] * s88_count   # S88を読んだときに保存するためのバッファを用意する。
+        self._s88_cv = threading.Condition()    # s88b を更新したら待っているスレッドを起こす
+        self._s88_seq = 0                       # s88b を更新した回数
+        self._s88_conds = []                    # wait_any などで待っている条件 (_S88Condition)
+        self.s88_updated_at = 0.0               # s88b を最後に更新した時刻 (time.monotonic)
+        self.s88_edges = S88EdgeBuffer()        # S88 のビットの変化の記録
+        self.s88_hooks = []                     # S88 を読むたびに fn(ds, 時刻, 前の状態, 新しい状態) を呼ぶ (すぐに返すこと)
+        # シリアルポートは I/O スレッドだけが触る。各スレッドはキューにコマンドを積む。
+        self._queues = [collections.deque() for _ in range(PRIORITY_POLL + 1)]     # 優先度ごとのキュー
+        self.starvation_limit = 0.5             # これ以上待たされたコマンドは優先度に関係なく送る
+        self.max_latency = [0.0] * (PRIORITY_POLL + 1)  # 優先度ごとの、積んでから応答までの最大時間
+        self.metrics = Metrics()
+        self.max_queue_depth = 0
+        self._metrics_server = None
+        self._queue_cv = threading.Condition()
+        self._inflight = collections.deque()    # 送信済みで応答待ちのコマンド
+        self._last_queued = {}                  # 宛先アドレス -> キューにある最後のコマンド (まとめる判定用)
+        self._state = {}                        # 状態キー -> 最後に 200 Ok を受けたコマンド
+        self._state_pending = {}                # 状態キー -> キューにある・応答待ちのコマンドの数
+        self._next_send_at = 0.0                # 次のコマンドを送ってよい時刻 (time.monotonic)
+        self.pipeline = max(1, pipeline)
+        self.pacing = Pacing() if pacing is None else pacing
+        self.reply_timeout = 1.0                # 応答がこれ以上来なければ失敗扱い
+        self._io_thread = None
+        self._reader_thread = None
+        self._io_running = False
+        self._reader_running = False
+        self.port = None
+        self.reset_on_open = True
+        self.auto_reconnect = False
+        self.reconnects = 0                     # 再接続した回数
+        self._reconnecting = False              # 再接続中はコマンドを送らずにキューに残す
+        self._reconnect_thread = None
+        self._reconnect_stop = threading.Event()
+        self._power = None                      # 最後に受け付けられた setPower (再接続で送り直す)
     
-    def open(self,port):
-        self.ser.port = port
+    # ポートを開いて DS とつなぐ。つながったら True。
+    # 開くと DS がリセットされるので、受信した行を解析しながら 100 Ready を待ち、来たらすぐに返す。(最大 timeout 秒)
+    # reset = False なら DTR を上げずに開き (DS をリセットしない)、100 Ready を待たずに setPing で確かめる。
+    # reconnect = True なら、読み書きに失敗したときに開き直して、電源・機関車・ポイントの状態を送り直す。
+    def open(self, port, reset = True, timeout = 4.0, reconnect = False):
+        self.port = port
+        self.reset_on_open = reset
+        self.auto_reconnect = reconnect
+        self._reconnect_stop.clear()
+        log.info('Waiting for DS ...')
+        try:
+            self.comm_ok = self._attach(timeout)
+        except Exception as e:   # 開けないときの処理
+            log.error("DS COMPORT_NG %s %s", port, e)
+            if self.ser.is_open:
+                self.ser.close()
+            return False
+        if self.comm_ok:
+            self.invalidate_state()         # リセットされたので前の状態は当てにならない
+            self._power = None
+            self._start_io_thread()
+            if not reset:
+                self.comm_ok = self._probe()
+                if not self.comm_ok:
+                    self._stop_io_thread()
+        if self.comm_ok:
+            log.info("DS COMM_OK")
+        else:
+            log.error("DS NO_RESPONSE")
+            self.ser.close()
+        return self.comm_ok
+
+    # ポートを開いて、DS が 100 Ready を送ってきたら True。reset_on_open でなければ開くだけ。
+    def _attach(self, timeout):
+        self.ser.port = self.port
         self.ser.baudrate = 115200
+        self.ser.timeout = 0.05
+        self.ser.dtr = self.reset_on_open
+        self.ser.open()      # これでリセットがかかる (reset_on_open のとき)
+        ready = not self.reset_on_open
+        parser = ReplyParser()
+        deadline = time.monotonic() + timeout
+        while not ready and time.monotonic() < deadline:
+            for reply in parser.feed(self.ser.read(self.ser.in_waiting or 1)):
+                log.debug("%r", reply.text)
+                if type(reply) is ReplyReady:
+                    ready = True
         self.ser.timeout = 1
+        return ready
+
+    # リセットせずに開いたとき、DS が応答するか確かめる。
+    def _probe(self):
         try:
-            self.ser.open()      # これでリセットがかかる
-        except:                  # 開けないときの処理
-            print("DS COMPORT_NG")
+            rcv = self.setPing(wait = False).result(self.reply_timeout * 2)
+        except Exception:
             return False
-        print('Waitihg for DS ...')
-        i = 0.0
-        while self.ser.in_waiting == 0 and i < 3.0:  #最初のデータが来るのを待つ
-            time.sleep(0.1)
-            i += 0.1
-        time.sleep(1)                               # 残りのデータが来るのを待つ
-        rcv = self.ser.read_all().decode()          # 残りのデータを読む
-        print(rcv)
-
-        if '100 Ready' in rcv:
-            print("DS COMM_OK")
-            self.comm_ok = True
-        else :
-            print("DS NO_RESPONSE")
-            self.comm_ok = False
-        
-        return self.comm_ok
-    
+        return bool(rcv) and rcv.ok
+
     def close(self):
-        print("DS CLOSE")
-        self.lock = False       # 強制的にロックを解除
+        log.info("DS CLOSE")
+        self._stop_reconnect()
+        if self.polling_s88_en:
+            self.stop_polling_s88()
         if self.ser.is_open :
             self.send_command("setPower(0)")
+        if self._io_thread is not None:
+            self._stop_io_thread()
+        if self.ser.is_open :
             self.ser.close()
-    
-    # 非同期でコマンドを送る場合にbusyだったら空くまで待つ
-    def unlock_check(self,timeout = 1.0):
-        i = 0.0
-        unlock = True
-        while self.lock and i < timeout:
-            time.sleep(0.01)
-            i += 0.01
-        if i >= timeout :
-            unlock = False
-            print("DS SEND_LOCKED")
-        return unlock
-
-    def send_command(self,command_str, lock_time = 0.1):
-        if not self.comm_ok :
-            print("DS NOT_OPEN")
+        self.comm_ok = False
+
+    # 再接続をやめる。つながらないままなら、キューに残っているコマンドは失敗させる。
+    def _stop_reconnect(self):
+        self.auto_reconnect = False
+        self._reconnect_stop.set()
+        th = self._reconnect_thread
+        if th is not None and th is not threading.current_thread():
+            th.join()
+        with self._queue_cv:
+            self._reconnecting = False
+            self._queue_cv.notify_all()
+
+    # 読み書きに失敗したときに I/O スレッドから呼ぶ。auto_reconnect なら再接続のスレッドを動かして True。
+    # 送信中のコマンドは、つながり直したら送り直すようにキューの先頭に戻す。
+    def _io_error(self, e):
+        with self._queue_cv:
+            if not self.auto_reconnect or not self._io_running:
+                return False
+            for c in reversed(self._inflight):
+                c.rewind()
+                self._queues[c.priority].appendleft(c)
+            self._inflight.clear()
+            self._next_send_at = 0.0
+            if self._reconnecting:
+                return True
+            log.error("DS IO_ERROR %s (reconnecting)", e)
+            self._reconnecting = True
+            self._reconnect_thread = threading.Thread(target=self._reconnect_loop, name="DS-RECONNECT", daemon=True)
+            self._reconnect_thread.start()
+        return True
+
+    # つながるまで開き直して、受信スレッドを動かし直し、状態を送り直してから送信を再開する。
+    # comm_ok はそのままなので、その間に積まれたコマンドはキューで待ち、呼び出し元は再接続に気付かない。
+    # S88 のポーリングも、読み取りのコマンドが待たされるだけで止まらない。
+    def _reconnect_loop(self):
+        with self._queue_cv:
+            self._reader_running = False
+        try:
+            self.ser.cancel_read()
+        except Exception:
+            pass
+        if self._reader_thread is not None and self._reader_thread is not threading.current_thread():
+            self._reader_thread.join()
+        delay = 0.5
+        while not self._reconnect_stop.is_set():
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+            self.ser = serial.Serial()      # 閉じられなかったポートの状態を持ち越さない
+            try:
+                if self._attach(4.0):
+                    break
+                log.warning("DS RECONNECT_NO_RESPONSE %s", self.port)
+            except Exception as e:
+                log.warning("DS RECONNECT_NG %s %s", self.port, e)
+            self._reconnect_stop.wait(delay)
+            delay = min(delay * 2, 5.0)
+        if self._reconnect_stop.is_set():
+            return
+        self.reconnects += 1
+        with self._queue_cv:
+            self._reader_running = True
+            replay = self._replay_commands()
+            for cmd in reversed(replay):                # キューの一番前に、この順番で
+                self._queues[cmd.priority].appendleft(cmd)
+                if cmd.state_key is not None:
+                    self._state_pending[cmd.state_key] = self._state_pending.get(cmd.state_key, 0) + 1
+        self._reader_thread = threading.Thread(target=self._read_loop, name="DS-RX", daemon=True)
+        self._reader_thread.start()
+        with self._queue_cv:
+            self._reconnecting = False
+            self._queue_cv.notify_all()
+        log.info("DS RECONNECTED %s (replayed %d commands)", self.port, len(replay))
+
+    # 再接続したときに送り直すコマンド。電源、方向・ファンクション・ポイント、速度の順。
+    # 切れている間に積まれた新しいコマンドがある状態は送り直さない (新しい方が勝つ)。_queue_cv を取った状態で呼ぶ。
+    def _replay_commands(self):
+        commands = []
+        if self._power is not None and not any(c.name == 'setPower' for q in self._queues for c in q):
+            commands.append(self._power)
+        commands += sorted((c for key, c in self._state.items() if key not in self._state_pending),
+                           key = lambda c: c.startswith('setLocoSpeed'))     # 速度は方向の後
+        return [_Command(c, None, priority = PRIORITY_STOP) for c in commands]
+
+    def _start_io_thread(self):
+        with self._queue_cv:
+            self._io_running = True
+            self._reader_running = True
+            self._next_send_at = 0.0
+        self._reader_thread = threading.Thread(target=self._read_loop, name="DS-RX", daemon=True)
+        self._reader_thread.start()
+        self._io_thread = threading.Thread(target=self._io_loop, name="DS-IO", daemon=True)
+        self._io_thread.start()
+
+    # キューに残っているコマンドを送り切り、応答を受け取ってから I/O スレッドを止める。
+    def _stop_io_thread(self):
+        with self._queue_cv:
+            self._io_running = False
+            self._queue_cv.notify_all()
+        if self._io_thread is not None and self._io_thread is not threading.current_thread():
+            self._io_thread.join()
+        self._io_thread = None
+        with self._queue_cv:
+            self._reader_running = False
+        if hasattr(self.ser, 'cancel_read'):
+            self.ser.cancel_read()
+        if self._reader_thread is not None and self._reader_thread is not threading.current_thread():
+            self._reader_thread.join()
+        self._reader_thread = None
+
+    # シリアルポートへの書き込みを専有するスレッド。
+    # 送信中のコマンドが pipeline 個未満で、前のコマンドのウェイトが明けたら次を送る。
+    def _io_loop(self):
+        while True:
+            expired = []
+            with self._queue_cv:
+                while True:
+                    now = time.monotonic()
+                    expired += self._expire_inflight(now)
+                    if expired:
+                        break
+                    queued = any(self._queues)
+                    if not queued and not self._io_running and not self._inflight:
+                        return
+                    deadline = None
+                    if self._inflight:
+                        deadline = self._inflight[0].sent_at + self._timeout_for(self._inflight[0])
+                    if queued and len(self._inflight) < self.pipeline and not self._reconnecting:
+                        if now >= self._next_send_at:
+                            break
+                        deadline = min(deadline or self._next_send_at, self._next_send_at)
+                    self._queue_cv.wait(None if deadline is None else max(0.0, deadline - now))
+                if expired:
+                    cmd = None
+                else:
+                    cmd = self._pop_next(now)
+                    if self._last_queued.get(cmd.target) is cmd:
+                        del self._last_queued[cmd.target]
+                    if not cmd.start():
+                        self._release_state(cmd)
+                        continue                # 送る前にキャンセルされた。
+                    cmd.sent_at = time.monotonic()
+                    self.metrics.observe('command_call_to_write_seconds', cmd.cls, cmd.sent_at - cmd.queued_at)
+                    self.metrics.count('commands_total', cmd.cls)
+                    self._inflight.append(cmd)
+                    if self.pipeline > 1:       # パイプライン時は送信時刻からウェイトを数える (200 Ok は待たない)
+                        self._next_send_at = cmd.sent_at + self.pacing.gap_for(cmd)
+                    else:                       # 応答が来るまで次は送らない
+                        self._next_send_at = float('inf')
+            for c in expired:
+                self._finish(c)
+            if cmd is None:
+                continue
+            try:
+                self.ser.write((cmd.command_str + '\r\n').encode())
+            except BaseException as e:
+                if self._io_error(e):
+                    continue                    # つながり直したら送り直す
+                with self._queue_cv:
+                    self._inflight.remove(cmd)
+                    self._next_send_at = 0.0
+                self._settle_state(cmd)
+                cmd.set_exception(e)
+                continue
+            serial_log.debug("TX %s", cmd.command_str)
+
+    # 次に送るコマンドをキューから取り出す。_queue_cv を取った状態で呼ぶ。
+    # 基本は優先度の高い順だが、starvation_limit 以上待たされたものがあれば一番古いものを先に送る。
+    # (停車が続いても S88 のポーリングが止まらないように)
+    def _pop_next(self, now):
+        starved = [q for q in self._queues if q and now - q[0].queued_at >= self.starvation_limit]
+        if starved:
+            return min(starved, key = lambda q: q[0].queued_at).popleft()
+        for q in self._queues:
+            if q:
+                return q.popleft()
+
+    # target 宛てのコマンドで priority より低い優先度のキューにあるものを priority のキューへ移す。
+    # 同じ機関車への停車が、先に積んだ速度・方向のコマンドを追い越さないようにする。_queue_cv を取った状態で呼ぶ。
+    def _promote(self, target, priority):
+        if target is None:
             return
-        
-        command_str += '\r\n'
-        rcv = ''
-        if self.unlock_check():
-            self.lock = True
-            self.ser.write(command_str.encode())
-            print(command_str)
-            rcv = self.ser.readline().decode()
-            time.sleep(0.01)           # 応答が複数の場合の間隔は 6msくらい。
-            rcv += self.ser.read_all().decode()
-            print(rcv)
-            if '200 Ok' in rcv:
-                time.sleep(lock_time)   # 200 Okの応答からウェイトを最低100ms以上置いてください。
+        moved = []
+        for q in self._queues[priority + 1:]:
+            for c in [c for c in q if c.target == target]:
+                q.remove(c)
+                moved.append(c)
+        for c in sorted(moved, key = lambda c: c.queued_at):
+            c.priority = priority
+            self._queues[priority].append(c)
+
+    # 応答を待つ秒数。Pacing に種類ごとの値があればそれを、無ければ reply_timeout を使う。
+    def _timeout_for(self, cmd):
+        return self.pacing.reply_timeout.get(cmd.cls, self.reply_timeout)
+
+    # 応答が待つ秒数以上来ないコマンドを送信中から外す。_queue_cv を取った状態で呼ぶ。
+    def _expire_inflight(self, now):
+        expired = []
+        while self._inflight and now - self._inflight[0].sent_at >= self._timeout_for(self._inflight[0]):
+            expired.append(self._inflight.popleft())
+            self.metrics.count('reply_timeouts_total', expired[-1].cls)
+        if expired and self.pipeline == 1:
+            self._next_send_at = 0.0
+        return expired
+
+    # 受信専用のスレッド。\r\n で行に区切って解析し、待っているコマンドに割り当てる。
+    def _read_loop(self):
+        parser = ReplyParser()
+        while self._reader_running:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except BaseException as e:
+                if self._reader_running:
+                    if self._io_error(e):
+                        return                  # 再接続のスレッドが受信スレッドを動かし直す
+                    self._on_read_error(e)
+                    return
+                continue
+            if not data:
+                continue
+            for reply in parser.feed(data):
+                self._dispatch_reply(reply)
+
+    # 再接続しないときに読めなくなったら (USB が抜けたなど)、受信をやめて待っているコマンドを全部失敗させる。
+    # comm_ok を落とすので、この後に呼んだコマンドはすぐに None を返す。
+    def _on_read_error(self, e):
+        log.error("DS READ_ERROR %s", e)
+        with self._queue_cv:
+            self.comm_ok = False
+            self._reader_running = False
+            inflight = list(self._inflight)
+            queued = [c for q in self._queues for c in q]
+            self._inflight.clear()
+            for q in self._queues:
+                q.clear()
+            self._last_queued.clear()
+            for c in queued:
+                self._release_state(c)
+            self._queue_cv.notify_all()
+        for c in inflight:
+            self._settle_state(c)
+            c.set_exception(e)
+        for c in queued:
+            if c.start():
+                c.set_exception(e)
+
+    # 解析した1行を待っているコマンドに割り当て、応答が揃ったら完了させる。
+    def _dispatch_reply(self, reply):
+        with self._queue_cv:
+            done = _match_reply(self._inflight, reply)
+            if done is None:
+                serial_log.info("RX (unexpected) %s", reply.text)
+                return
+            if not done.complete():
+                return
+            self._inflight.remove(done)
+            now = time.monotonic()
+            if done.ok():
+                self.pacing.record_ack(done.cls, now - done.sent_at)
+                self.metrics.observe('command_write_to_ack_seconds', done.cls, now - done.sent_at)
+            if self.pipeline == 1:
+                # 200 Okの応答からウェイトを最低100ms以上置いてください。
+                self._next_send_at = now + (self.pacing.gap_for(done) if done.ok() else 0.0)
+            self._queue_cv.notify_all()
+        self._finish(done)
+
+    def _finish(self, cmd):
+        latency = time.monotonic() - cmd.queued_at
+        if latency > self.max_latency[cmd.priority]:
+            self.max_latency[cmd.priority] = latency
+        rcv = cmd.reply()
+        serial_log.debug("RX %r (%s)", rcv, cmd.command_str)
+        if not cmd.ok():
+            log.warning("DS REPLY_ERROR %s -> %r", cmd.command_str, rcv)
+            self.metrics.count('reply_errors_total', cmd.cls)
+        if cmd.name == 'setPower' and cmd.ok():
+            self._power = cmd.command_str
+        self._settle_state(cmd)
+        cmd.set_result(rcv)
+
+    # 送らなかったコマンドを応答待ちの数から外す。_queue_cv を取った状態で呼ぶ。
+    def _release_state(self, cmd):
+        if cmd.state_key is not None:
+            self._state_pending[cmd.state_key] -= 1
+            if not self._state_pending[cmd.state_key]:
+                del self._state_pending[cmd.state_key]
+
+    # 応答が来た(または失敗した)コマンドを状態キャッシュに反映する。
+    def _settle_state(self, cmd):
+        if cmd.state_key is None:
+            return
+        with self._queue_cv:
+            self._release_state(cmd)
+            if cmd.ok():
+                self._state[cmd.state_key] = cmd.command_str
             else:
-                print("DS REPLY_ERROR")
-            self.lock = False
-        return rcv
+                self._state.pop(cmd.state_key, None)        # どうなったか分からないので次は必ず送る
+
+    # 状態キャッシュを捨てる。DS の電源を入れ直したときや、再接続したときに呼ぶ。
+    # addr を指定するとその機関車の分だけ捨てる。
+    def invalidate_state(self, addr = None):
+        with self._queue_cv:
+            if addr is None:
+                self._state.clear()
+            else:
+                target = str(0xC000 + addr)
+                for key in [k for k in self._state if k[1] == target]:
+                    del self._state[key]
+
+    # コマンドをキューに積んで、応答を受け取る future を返す。
+    # 呼び出し元は待たずに次の処理に進める。送信順はキューに積んだ順(FIFO)。
+    # lock_time は応答後に置く間隔。None ならコマンドの種類ごとの間隔 (self.pacing) に従う。
+    # coalesce = True のとき、同じ宛先に対する同じコマンドがまだ送られずにキューの最後にあれば、
+    # その場で新しい内容に置き換える (後勝ち)。古い呼び出しの future も同じ応答で完了する。
+    # 間に同じ宛先への別のコマンドがあれば置き換えないので、速度と方向の順番は崩れない。
+    # 速度・方向・ファンクション・ポイントは、最後に受け付けられた状態と同じで、送信待ちも無ければ送らない。
+    # そのときの結果は None。force = True なら必ず送る。
+    # priority を省略するとコマンドの種類で決まる。(PRIORITY_STOP ～ PRIORITY_POLL)
+    def submit_command(self, command_str, lock_time = None, coalesce = False, force = False, priority = None):
+        if not self.comm_ok :
+            log.warning("DS NOT_OPEN %s", command_str)
+            return _done_future(None)
+        cmd = _Command(command_str, lock_time, priority = priority)
+        with self._queue_cv:
+            if cmd.state_key is not None and not force and cmd.state_key not in self._state_pending \
+                    and self._state.get(cmd.state_key) == command_str:
+                self.metrics.count('commands_skipped_total', cmd.cls)
+                return _done_future(None)       # 状態が変わらないので送らない
+            last = self._last_queued.get(cmd.target)
+            if coalesce and last is not None and last.name == cmd.name:
+                last.command_str = cmd.command_str
+                last.lock_time = cmd.lock_time
+                last.merged.append(cmd.future)
+                self.metrics.count('commands_coalesced_total', cmd.cls)
+                if cmd.priority < last.priority:
+                    self._promote(cmd.target, cmd.priority)
+                    self._queue_cv.notify()
+                return cmd.future
+            self._promote(cmd.target, cmd.priority)
+            self._queues[cmd.priority].append(cmd)
+            depth = sum(len(q) for q in self._queues)
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+            if cmd.target is not None:
+                self._last_queued[cmd.target] = cmd
+            if cmd.state_key is not None:
+                self._state_pending[cmd.state_key] = self._state_pending.get(cmd.state_key, 0) + 1
+            self._queue_cv.notify()
+        return cmd.future
+
+    # コマンドを送って応答が来るまで待つ。応答の文字列を返す。
+    def send_command(self,command_str, lock_time = None, priority = None):
+        return self.submit_command(command_str, lock_time, priority = priority).result()
+
+    # wait = False のときは future を返す。
+    def _request(self, command_str, lock_time = None, wait = True, coalesce = False, force = False, priority = None):
+        future = self.submit_command(command_str, lock_time, coalesce, force, priority)
+        return future.result() if wait else future
+
+    def setPing(self, wait = True):
+        return self._request("setPing()", wait = wait)
+
+    def setPower(self, on, wait = True):
+        return self._request("setPower(" + str(on) + ")", wait = wait)
 
-    def setPing(self):
-        self.send_command("setPing()")
+    def setLocoSpeed(self, addr, speed, speed_step = 0, wait = True, force = False):
+        return self._request("setLocoSpeed(" + str(0xC000 + addr) + "," + str(speed) + "," + str(speed_step) + ")", wait = wait, coalesce = True, force = force)
 
-    def setPower(self, on):
-        self.send_command("setPower(" + str(on) + ")")
+    def setLocoDirection(self, addr, dir, wait = True, force = False):  # dir = 1 or 2
+        return self._request("setLocoDirection(" + str(0xC000 + addr) + "," + str(dir) + ")", wait = wait, coalesce = True, force = force)
 
-    def setLocoSpeed(self, addr, speed, speed_step = 0):
-        self.send_command("setLocoSpeed(" + str(0xC000 + addr) + "," + str(speed) + "," + str(speed_step) + ")")
+    def setLocoFunction(self, addr, num, on, wait = True, force = False):
+        return self._request("setLocoFunction(" + str(0xC000 + addr) + "," + str(num) + "," + str(on) + ")", wait = wait, force = force)
 
-    def setLocoDirection(self, addr, dir):  # dir = 1 or 2
-        self.send_command("setLocoDirection(" + str(0xC000 + addr) + "," + str(dir) + ")",)
+    def setLocoConfig(self, addr, value, wait = True):
+        return self._request("setLocoConfig(" + str(0xC000 + addr) + "," + str(value) + ")", wait = wait)
 
-    def setLocoFunction(self, addr, num, on):
-        self.send_command("setLocoFunction(" + str(0xC000 + addr) + "," + str(num) + "," + str(on) + ")")
+    def getLocoConfig(self, addr, num, wait = True):
+        return self._request("getLocoConfig(" + str(0xC000 + addr) + "," + str(num) + ")", wait = wait)     # 例 : @CV,49162,8,129,\r\n 
 
-    def setLocoConfig(self, addr, value):
-        self.send_command("setLocoConfig(" + str(0xC000 + addr) + "," + str(value) + ")")
+    # CV 番号 num に value を書く。(setLocoConfig の CV 番号を指定する形)
+    def setLocoConfigValue(self, addr, num, value, wait = True):
+        return self._request("setLocoConfig(" + str(0xC000 + addr) + "," + str(num) + "," + str(value) + ")", wait = wait)
 
-    def getLocoConfig(self, addr, num):
-        rcv = self.send_command("getLocoConfig(" + str(0xC000 + addr) + "," + str(num) + ")")
-        return rcv      # 例 : @CV,49162,8,129,\r\n 
+    # CV の値を数で返す。読めなければ None。
+    def getLocoConfigValue(self, addr, num, wait = True):
+        future = _chain_future(self.submit_command("getLocoConfig(" + str(0xC000 + addr) + "," + str(num) + ")"),
+                               lambda rcv: self._parse_cv(rcv, 0xC000 + addr, num))
+        return future.result() if wait else future
 
-    def setTurnout(self, addr, dir):        # dir: even = 0, odd = 1
-        self.send_command("setTurnout(" + str(0x3800 + addr - 1) + "," + str(dir) + ")", 0.1)    # これも1始まり。切り替わり時間を待つ(実験したところ、0.1で良かった。)
+    # @CV,アドレス,CV番号,値, の応答から値を取り出す。addr (0xC000 を足したもの), num を指定すると、
+    # 応答のアドレスと CV 番号がそれと違えば None。(別の読み出しの応答を値として使わない)
+    @staticmethod
+    def _parse_cv(rcv, addr = None, num = None):
+        if type(getattr(rcv, 'data', None)) is ReplyCV:
+            data = rcv.data
+        elif not rcv or '@CV,' not in rcv:
+            return None
+        else:
+            s = rcv[rcv.index('@CV,'):].split('\r\n', 1)[0].split(',')
+            try:
+                data = ReplyCV(int(s[1]), int(s[2]), int(s[3]), None)
+            except (IndexError, ValueError):
+                return None
+        if (addr is not None and data.addr != addr) or (num is not None and data.num != num):
+            log.warning("DS CV_MISMATCH expected %s,%s got %s,%s", addr, num, data.addr, data.num)
+            return None
+        return data.value
+
+    def setTurnout(self, addr, dir, wait = True, force = False):        # dir: even = 0, odd = 1
+        return self._request("setTurnout(" + str(0x3800 + addr - 1) + "," + str(dir) + ")", wait = wait, force = force)    # これも1始まり。切り替わり時間は Pacing の 'turnout' で待つ(実験したところ、0.1で良かった。)
     
-    def getS88(self, count):
-        rcv = self.send_command("getS88(" + str(count) + ")", 0.01)    # 3msくらいで応答するみたい。
-        retval = -1
-        if '@S88,' in rcv:
-            s = rcv.split(',')
-            retval = int(s[count], 16)
-        return retval
+    def getS88(self, count, wait = True):
+        future = _chain_future(self.submit_command("getS88(" + str(count) + ")"), lambda rcv: self._parse_s88(rcv, count))    # 3msくらいで応答するみたい。
+        return future.result() if wait else future
+
+    # 1番目から count 番目までの S88 装置を1回のコマンドでまとめて読む。
+    # 応答は @S88,xxxx,yyyy,... と装置の数だけ並ぶので、全部を int のリストにして返す。読めなければ None。
+    def getS88Words(self, count, wait = True):
+        future = _chain_future(self.submit_command("getS88(" + str(count) + ")"), lambda rcv: self._parse_s88_words(rcv, count))
+        return future.result() if wait else future
+
+    @staticmethod
+    def _parse_s88(rcv, count):
+        words = DesktopStation._parse_s88_words(rcv, count)
+        return -1 if words is None else words[count - 1]
+
+    @staticmethod
+    def _parse_s88_words(rcv, count):
+        if type(getattr(rcv, 'data', None)) is ReplyS88:
+            words = rcv.data.words
+            return words[:count] if len(words) >= count else None
+        if not rcv or '@S88,' not in rcv:
+            return None
+        s = rcv[rcv.index('@S88,'):].split('\r\n', 1)[0].split(',')
+        try:
+            return [int(s[i + 1], 16) for i in range(count)]
+        except (IndexError, ValueError):
+            return None
 
     # S88 のバッファ s88b を更新する。
-    def updateS88b(self):
-        for i in range(len(self.s88b)):                        # 複数の S88装置は未検証（持ってないので。）
-            self.s88b[i] = int(self.getS88(i + 1))             # 1から始まるので。配列は0から。
-            print("S88-" + str(i + 1) + ":" + format(int(self.s88b[i]),'#018b'))
+    # 全装置を getS88(装置の数) の1往復で読むので、装置が増えても時間は変わらない。
+    # count を指定すると 1 番目から count 番目の装置だけを読む。
+    def updateS88b(self, count = None):
+        words = self.getS88Words(count or len(self.s88b))      # 複数の S88装置は未検証（持ってないので。）
+        if words is None:                                      # 読めなかったら前の値のまま
+            return False
+        if s88_log.isEnabledFor(logging.DEBUG):
+            s88_log.debug("S88:" + " ".join(str(i + 1) + "-" + format(w,'#018b') for i, w in enumerate(words)))
+        self._publish_s88(words)
         return True
 
+    # 新しい S88 の状態を s88b に反映して、waitForS88 で待っているスレッドを起こす。
+    # 前の状態から変わったビットは s88_edges に記録する。
+    def _publish_s88(self, words):
+        now = time.monotonic()
+        with self._s88_cv:
+            for fn in self.s88_hooks:
+                fn(self, now, self.s88b, words)
+            self.s88_edges.push_diff(now, self.s88b, words)
+            self.s88b[:len(words)] = words
+            self._s88_seq += 1
+            self.s88_updated_at = now
+            for cond in [c for c in self._s88_conds if c.check(self.s88b, now)]:
+                self._s88_conds.remove(cond)
+                cond.event.set()
+            self._s88_cv.notify_all()
+
+    # S88 のビットの変化 (S88Edge) を受け取る読み手を作る。呼んだ時点より後の変化を受け取る。
+    # 変化はポーリングや waitForS88 で S88 を読んだときに、前の状態と比べて記録する。
+    def subscribe_s88_edges(self):
+        return self.s88_edges.subscribe()
+
+    # ポーリングの開始・停止を waitForS88 で待っているスレッドに知らせる。
+    def _notify_s88_waiters(self):
+        with self._s88_cv:
+            for cond in self._s88_conds:
+                cond.event.set()
+            self._s88_cv.notify_all()
+
+    # count 個目の S88 装置を見ていることをポーリングのスレッドに知らせる。unwatch_s88 と対で呼ぶ。
+    # idle_interval を指定してポーリングしているときは、見られている装置だけを polling_interval で読む。
+    # waitForS88 は待っている間、自動でこれを呼ぶ。
+    def watch_s88(self, count):
+        with self._s88_cv:
+            self._s88_watch[count] += 1
+            first = self._s88_watch[count] == 1
+        if first:
+            self._poll_wake.set()
+
+    def unwatch_s88(self, count):
+        with self._s88_cv:
+            self._s88_watch[count] -= 1
+            if self._s88_watch[count] <= 0:
+                del self._s88_watch[count]
+
+    # 速く読む装置の数。getS88(n) は 1 番目から n 番目までを読むので、見られている一番後ろの装置まで読む。
+    def _watched_units(self):
+        if self.idle_interval is None:
+            return 0
+        with self._s88_cv:
+            return min(max(self._s88_watch, default = 0), len(self.s88b))
+
     # count 個目の s88b のバッファから該当(num)の位置のビットを読む。
     def readS88b(self, count, num):
         a = self.s88b[count - 1]     # 1から始まるらしい。
@@ -135,33 +1327,211 @@ class DesktopStation:
         return arrived
 
     # count 個目の S88 装置の num番目のビットがHになるのを待つ。
-    def waitForS88(self, count, num, timeout = 60):
-        i = 0
-        arrived = False
-        while arrived == False and i < timeout:
+    # ポーリング中は s88b が更新されるまで眠って待つ。ポーリングしていなければ 0.1 秒毎に自分で読む。
+    # 結果は S88WaitResult で返す。raise_on_timeout = True ならタイムアウト時に S88Timeout を投げる。
+    def waitForS88(self, count, num, timeout = 60, raise_on_timeout = False):
+        cond = self._wait_condition(_S88Condition('any', [[(count, num)]]), timeout)
+        result = S88WaitResult(count, num, cond.fired, cond.elapsed, cond.times[-1] if cond.fired else None)
+        self.metrics.observe('s88_wait_seconds', 'arrived' if cond.fired else 'timeout', result.elapsed)
+        if not cond.fired and raise_on_timeout:
+            raise S88Timeout(result)
+        return result
+
+    # bits のどれかがHになるのを待つ。bits はビット番号 (1番目の装置) か (装置番号, ビット番号) のリスト。
+    # 以下の wait_* は条件を装置ごとのビットマスクにして、S88 を読むたびに1回だけ調べる。
+    # 結果は S88ConditionResult で返す。timeout, raise_on_timeout は waitForS88 と同じ。
+    def wait_any(self, bits, timeout = 60, raise_on_timeout = False):
+        return self._wait(_S88Condition('any', [[_s88_bit(b) for b in bits]]), timeout, raise_on_timeout)
+
+    # bits が全部同時にHになるのを待つ。
+    def wait_all(self, bits, timeout = 60, raise_on_timeout = False):
+        return self._wait(_S88Condition('all', [[_s88_bit(b) for b in bits]]), timeout, raise_on_timeout)
+
+    # bits がこの順番にHになるのを待つ。1周分のセンサを1回の登録で待てて、待ちの間で変化を見逃さない。
+    # 結果の times に各ビットがHになった時刻が入る。タイムアウトしたときは index まで進んでいる。
+    def wait_sequence(self, bits, timeout = 60, raise_on_timeout = False):
+        return self._wait(_S88Condition('sequence', [[_s88_bit(b)] for b in bits]), timeout, raise_on_timeout)
+
+    # predicate(words) が真になるのを待つ。words は s88b (装置ごとのビット) で、読むだけにすること。
+    # predicate は S88 を読んだスレッドで呼ばれるので、すぐに返すこと。units は見る装置の数 (既定は全部)。
+    def wait_until(self, predicate, timeout = 60, raise_on_timeout = False, units = None):
+        return self._wait(_S88Condition('until', predicate = predicate, units = units or len(self.s88b)),
+                          timeout, raise_on_timeout)
+
+    def _wait(self, cond, timeout, raise_on_timeout):
+        self._wait_condition(cond, timeout)
+        if cond.error is not None:
+            raise cond.error
+        result = S88ConditionResult(cond.kind, cond.bits, cond.fired, cond.value, cond.index, cond.times, cond.elapsed)
+        self.metrics.observe('s88_wait_seconds', 'arrived' if cond.fired else 'timeout', result.elapsed)
+        if not cond.fired and raise_on_timeout:
+            raise S88Timeout(result)
+        return result
+
+    # 条件を登録して、成り立つかタイムアウトするまで待つ。
+    def _wait_condition(self, cond, timeout):
+        start = time.monotonic()
+        deadline = start + timeout
+        self.watch_s88(cond.units)
+        try:
             if not self.polling_s88_en:
                 self.updateS88b()
-            arrived = self.readS88b(count, num)
-            if not arrived:
-                time.sleep(0.1)
-                i += 0.1
-        if i >= timeout :
-            print("DS NOT_ARRIVED")
-        return arrived
+            with self._s88_cv:
+                if cond.check(self.s88b, time.monotonic()):    # 今の状態で成り立っている
+                    cond.event.set()
+                else:
+                    self._s88_conds.append(cond)
+            while True:
+                cond.event.clear()      # ポーリングの開始・停止でも起きるので、起きたら成り立ったかを調べる
+                if cond.fired or cond.error is not None:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self.polling_s88_en:
+                    cond.event.wait(remaining)
+                elif not cond.event.wait(min(remaining, 0.1)):
+                    self.updateS88b()
+        finally:
+            with self._s88_cv:
+                if cond in self._s88_conds:
+                    self._s88_conds.remove(cond)
+            self.unwatch_s88(cond.units)
+        cond.elapsed = time.monotonic() - start
+        return cond
     
+    # 計測値のスナップショットを返す。
+    def stats(self):
+        result = self.metrics.snapshot()
+        with self._queue_cv:
+            result['queue_depth'] = {str(p): len(q) for p, q in enumerate(self._queues)}
+            result['inflight'] = len(self._inflight)
+        result['max_queue_depth'] = self.max_queue_depth
+        result['max_latency_seconds'] = {str(p): t for p, t in enumerate(self.max_latency)}
+        result['pacing_gap_seconds'] = dict(self.pacing.gap)
+        return result
+
+    # Prometheus のテキスト形式の計測値。
+    def prometheus_text(self):
+        with self._queue_cv:
+            gauges = {'queue_depth': sum(len(q) for q in self._queues), 'inflight_commands': len(self._inflight)}
+        gauges['max_queue_depth'] = self.max_queue_depth
+        return self.metrics.prometheus(gauges)
+
+    # http://host:port/metrics で Prometheus から計測値を読めるようにする。既定ではこの PC からだけ。
+    def start_metrics_server(self, port = 9108, host = '127.0.0.1'):
+        import http.server
+        ds = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = ds.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self._metrics_server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._metrics_server.serve_forever, name="DS-METRICS", daemon=True).start()
+        return self._metrics_server.server_address[1]
+
+    def stop_metrics_server(self):
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+
+    # ポーリングのスレッド。読み終わった時刻からではなく、開始時刻から interval 刻みの時刻に読むので周期がずれていかない。
+    # 読むのが間に合わなかった時刻は飛ばして(まとめて読み直さない)、poll_overruns に数える。
+    # idle_interval を指定したときは、見られている装置 (watch_s88) までを polling_interval で、
+    # 全装置を idle_interval (誰も見ていなければ heartbeat_interval) で読む。
     def polling_s88(self):
-        self.updateS88b()
-        if self.polling_s88_en :
-            self.tm = threading.Timer( self.polling_interval , self.polling_s88 )   # 自動で再起動しないので毎回自分をセットする。
-            self.tm.start()
+        next_all = time.monotonic() + self._all_interval(0)    # 全装置を読む時刻
+        next_fast = None                                        # 見られている装置を読む時刻
+        last = {}                                               # 読んだ種類 -> 最後に読んだ時刻
+        while self.polling_s88_en:
+            self._poll_wake.clear()
+            units = self._watched_units()
+            now = time.monotonic()
+            if not units:
+                next_fast = None
+                last.pop('watched', None)
+            elif next_fast is None:                             # 見始めたらすぐ読む
+                next_fast = now
+                next_all = min(next_all, now + self._all_interval(units))
+            deadline = next_all if next_fast is None else min(next_all, next_fast)
+            if self._poll_wake.wait(max(0.0, deadline - now)):
+                continue                                        # 止めるか、見る装置が変わった
+            if next_fast is None or next_all <= next_fast:
+                kind, interval = 'poll', self._all_interval(units)
+                self._poll_once(None)
+                if next_fast is not None:                       # 見られている装置も今読んだ
+                    next_fast = max(next_fast, next_all + self.polling_interval)
+                next_all = self._next_poll(next_all, interval)
+            else:
+                kind, interval = 'watched', self.polling_interval
+                self._poll_once(units)
+                next_fast = self._next_poll(next_fast, interval)
+            now = time.monotonic()
+            if kind in last:
+                period = now - last[kind]
+                self.metrics.observe('s88_poll_period_seconds', kind, period)
+                self.metrics.observe('s88_poll_jitter_seconds', kind, abs(period - interval))
+            last[kind] = now
+
+    def _all_interval(self, units):
+        if self.idle_interval is None:
+            return self.polling_interval
+        if units or self.heartbeat_interval is None:
+            return self.idle_interval
+        return self.heartbeat_interval
+
+    def _poll_once(self, count):
+        try:
+            self.updateS88b(count)
+        except Exception:
+            s88_log.exception("S88 POLLING_ERROR")
+
+    # at の次の読む時刻。もう過ぎていたら、間に合わなかった分を飛ばす。
+    def _next_poll(self, at, interval):
+        at += interval
+        now = time.monotonic()
+        if now >= at:
+            missed = int((now - at) // interval) + 1
+            at += missed * interval
+            self.poll_overruns += missed
+            self.metrics.count('s88_poll_overruns_total', 'poll', missed)
+            s88_log.debug("S88 POLLING_OVERRUN %d", missed)
+        return at
     
-    def start_polling_s88(self, interval = 0.1):
-        print("S88 POLLING_START")
+    # interval は見られている装置を読む間隔。idle_interval を指定すると、誰も待っていない装置は
+    # その間隔でしか読まなくなり、空いた分をコマンドに回せる。誰も待っていないときは heartbeat_interval。
+    # (指定しなければ idle_interval) idle_interval = None なら全装置を interval で読む。
+    def start_polling_s88(self, interval = 0.1, idle_interval = None, heartbeat_interval = None):
+        if self.polling_s88_en:
+            self.stop_polling_s88()
+        s88_log.info("S88 POLLING_START")
         self.polling_interval = interval
+        self.idle_interval = idle_interval
+        self.heartbeat_interval = heartbeat_interval
         self.polling_s88_en = True
-        self.polling_s88()
+        self._notify_s88_waiters()
+        self.updateS88b()                       # 1回目はすぐに読む
+        self._poll_wake.clear()
+        self._poll_thread = threading.Thread(target=self.polling_s88, name="DS-S88", daemon=True)
+        self._poll_thread.start()
     
+    # ポーリングしていないときに呼んでもよい。読んでいる途中なら読み終わるのを待つ。
     def stop_polling_s88(self):
         self.polling_s88_en = False
-        self.tm.cancel()
-        print("S88 POLLING_STOP")
+        self._poll_wake.set()
+        if self._poll_thread is not None:
+            if self._poll_thread is not threading.current_thread():
+                self._poll_thread.join()
+            self._poll_thread = None
+        self._notify_s88_waiters()
+        s88_log.info("S88 POLLING_STOP")
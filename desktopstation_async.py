@@ -0,0 +1,403 @@
+'''
+desktopstation_async.py
+Description: DesktopStation を asyncio から使うためのクライアントです。
+DesktopStation と同じ名前のメソッドをコルーチンとして持ちます。
+列車ごとにスレッドを作らず、1つのイベントループで多数の列車・センサ待ちを扱えます。
+'''
+
+import asyncio, collections, os, time, serial
+import desktopstation
+from desktopstation import _Command, _match_reply, ReplyParser, ReplyReady, Pacing, S88EdgeBuffer, S88WaitResult, S88Timeout, log, serial_log, s88_log
+
+class AsyncDesktopStation:
+    # 引数は DesktopStation と同じ。
+    def __init__(self, s88_count = 1, pipeline = 1, pacing = None):
+        self.ser = serial.Serial()
+        self.comm_ok = False
+        self.polling_s88_en = False
+        self.s88b = [0] * s88_count
+        self.s88_updated_at = 0.0       # s88b を最後に更新した時刻 (time.monotonic)
+        self.pipeline = max(1, pipeline)
+        self.pacing = Pacing() if pacing is None else pacing
+        self.reply_timeout = 1.0
+        self._loop = None
+        self._queue = collections.deque()
+        self._inflight = collections.deque()
+        self._next_send_at = 0.0
+        self._wakeup = None             # 送信タスクを起こすためのイベント
+        self._writer_task = None
+        self._reader_task = None        # add_reader が使えない環境(Windows)での受信タスク
+        self._poll_task = None
+        self.polling_interval = 0.1
+        self.idle_interval = None
+        self.heartbeat_interval = None
+        self._poll_wake = None          # 見る装置が増えたらポーリングのタスクを起こす
+        self.poll_overruns = 0          # ポーリングが間に合わずに飛ばした回数
+        self._running = False
+        self._parser = ReplyParser()    # 受信バッファ
+        self._ready = None              # 100 Ready を受けたらセット
+        self._bit_waiters = {}          # (count, num) -> そのビットを待っている future のリスト
+        self.s88_edges = S88EdgeBuffer()
+
+    async def open(self, port, timeout = 4.0):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._ready = asyncio.Event()
+        self.ser.port = port
+        self.ser.baudrate = 115200
+        self.ser.timeout = 0 if os.name == 'posix' else 0.05
+        try:
+            self.ser.open()      # これでリセットがかかる
+        except:                  # 開けないときの処理
+            log.error("DS COMPORT_NG %s", port)
+            return False
+        log.info('Waiting for DS ...')
+        self._parser.clear()
+        self._running = True
+        if os.name == 'posix':
+            self._loop.add_reader(self.ser.fileno(), self._on_readable)
+        else:
+            self._reader_task = self._loop.create_task(self._read_task())
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)     # 100 Ready が来たらすぐ抜ける
+            log.info("DS COMM_OK")
+            self.comm_ok = True
+        except asyncio.TimeoutError:
+            log.error("DS NO_RESPONSE")
+            self.comm_ok = False
+        if self.comm_ok:
+            self._writer_task = self._loop.create_task(self._write_task())
+        else:
+            await self._stop_io()
+            self.ser.close()
+        return self.comm_ok
+
+    async def close(self):
+        log.info("DS CLOSE")
+        if self.polling_s88_en:
+            await self.stop_polling_s88()
+        if self.ser.is_open:
+            await self.send_command("setPower(0)")
+            await self._stop_io()
+            self.ser.close()
+        self.comm_ok = False
+
+    # 残っているコマンドを送り切ってから送受信を止める。
+    async def _stop_io(self):
+        self._running = False
+        self._wakeup.set()
+        if self._writer_task is not None:
+            await self._writer_task
+            self._writer_task = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        elif self.ser.is_open and os.name == 'posix':
+            self._loop.remove_reader(self.ser.fileno())
+
+    # 送信タスク。DesktopStation._io_loop と同じ規則でウェイトを置いて送る。
+    async def _write_task(self):
+        while True:
+            now = time.monotonic()
+            self._expire_inflight(now)
+            if not self._queue and not self._running and not self._inflight:
+                return
+            deadline = None
+            if self._inflight:
+                deadline = self._inflight[0].sent_at + self._timeout_for(self._inflight[0])
+            if self._queue and len(self._inflight) < self.pipeline:
+                if now >= self._next_send_at:
+                    self._send(self._queue.popleft())
+                    continue
+                deadline = min(deadline or self._next_send_at, self._next_send_at)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if deadline is None else max(0.0, deadline - now))
+            except asyncio.TimeoutError:
+                pass
+
+    def _send(self, cmd):
+        if cmd.future.cancelled():
+            return                      # 送る前にキャンセルされた。
+        cmd.sent_at = time.monotonic()
+        try:
+            self.ser.write((cmd.command_str + '\r\n').encode())
+        except Exception as e:
+            cmd.future.set_exception(e)
+            return
+        serial_log.debug("TX %s", cmd.command_str)
+        self._inflight.append(cmd)
+        if self.pipeline > 1:
+            self._next_send_at = cmd.sent_at + self.pacing.gap_for(cmd)
+        else:
+            self._next_send_at = float('inf')
+
+    def _timeout_for(self, cmd):
+        return self.pacing.reply_timeout.get(cmd.cls, self.reply_timeout)
+
+    def _expire_inflight(self, now):
+        while self._inflight and now - self._inflight[0].sent_at >= self._timeout_for(self._inflight[0]):
+            self._finish(self._inflight.popleft())
+            if self.pipeline == 1:
+                self._next_send_at = 0.0
+
+    # シリアルポートにデータが来たときにイベントループから呼ばれる。
+    def _on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except Exception as e:
+            self._on_read_error(e)
+            return
+        self._feed(data)
+
+    async def _read_task(self):
+        while True:
+            try:
+                data = await self._loop.run_in_executor(None, lambda: self.ser.read(self.ser.in_waiting or 1))
+            except Exception as e:
+                self._on_read_error(e)
+                return
+            self._feed(data)
+
+    # 読めなくなったら (USB が抜けたなど) 受信をやめて、待っているコマンドを全部失敗させる。
+    # 抜けたポートは読める状態のままになるので、add_reader を外さないとイベントループが回り続ける。
+    def _on_read_error(self, e):
+        log.error("DS READ_ERROR %s", e)
+        if self._reader_task is None and os.name == 'posix':
+            try:
+                self._loop.remove_reader(self.ser.fileno())
+            except Exception:
+                pass
+        self.comm_ok = False
+        self._running = False
+        for cmd in list(self._inflight) + list(self._queue):
+            if not cmd.future.done():
+                cmd.future.set_exception(e)
+        self._inflight.clear()
+        self._queue.clear()
+        self._wakeup.set()
+
+    def _feed(self, data):
+        if not data:
+            return
+        for reply in self._parser.feed(data):
+            self._dispatch_reply(reply)
+
+    def _dispatch_reply(self, reply):
+        if type(reply) is ReplyReady:
+            self._ready.set()
+            return
+        done = _match_reply(self._inflight, reply)
+        if done is None:
+            serial_log.info("RX (unexpected) %s", reply.text)
+            return
+        if not done.complete():
+            return
+        self._inflight.remove(done)
+        now = time.monotonic()
+        if done.ok():
+            self.pacing.record_ack(done.cls, now - done.sent_at)
+        if self.pipeline == 1:
+            # 200 Okの応答からウェイトを最低100ms以上置いてください。
+            self._next_send_at = now + (self.pacing.gap_for(done) if done.ok() else 0.0)
+        self._wakeup.set()
+        self._finish(done)
+
+    def _finish(self, cmd):
+        rcv = cmd.reply()
+        serial_log.debug("RX %r (%s)", rcv, cmd.command_str)
+        if not cmd.ok():
+            log.warning("DS REPLY_ERROR %s -> %r", cmd.command_str, rcv)
+        if not cmd.future.done():
+            cmd.future.set_result(rcv)
+
+    # コマンドをキューに積んで、応答を受け取る asyncio の future を返す。
+    def submit_command(self, command_str, lock_time = None):
+        future = asyncio.get_running_loop().create_future()
+        if not self.comm_ok:
+            log.warning("DS NOT_OPEN %s", command_str)
+            future.set_result(None)
+            return future
+        self._queue.append(_Command(command_str, lock_time, future))
+        self._wakeup.set()
+        return future
+
+    async def send_command(self, command_str, lock_time = None):
+        return await self.submit_command(command_str, lock_time)
+
+    async def setPing(self):
+        return await self.send_command("setPing()")
+
+    async def setPower(self, on):
+        return await self.send_command("setPower(" + str(on) + ")")
+
+    async def setLocoSpeed(self, addr, speed, speed_step = 0):
+        return await self.send_command("setLocoSpeed(" + str(0xC000 + addr) + "," + str(speed) + "," + str(speed_step) + ")")
+
+    async def setLocoDirection(self, addr, dir):  # dir = 1 or 2
+        return await self.send_command("setLocoDirection(" + str(0xC000 + addr) + "," + str(dir) + ")")
+
+    async def setLocoFunction(self, addr, num, on):
+        return await self.send_command("setLocoFunction(" + str(0xC000 + addr) + "," + str(num) + "," + str(on) + ")")
+
+    async def setLocoConfig(self, addr, value):
+        return await self.send_command("setLocoConfig(" + str(0xC000 + addr) + "," + str(value) + ")")
+
+    async def getLocoConfig(self, addr, num):
+        return await self.send_command("getLocoConfig(" + str(0xC000 + addr) + "," + str(num) + ")")
+
+    async def setTurnout(self, addr, dir):        # dir: even = 0, odd = 1
+        return await self.send_command("setTurnout(" + str(0x3800 + addr - 1) + "," + str(dir) + ")")
+
+    async def getS88(self, count):
+        return desktopstation.DesktopStation._parse_s88(await self.send_command("getS88(" + str(count) + ")"), count)
+
+    async def getS88Words(self, count):
+        return desktopstation.DesktopStation._parse_s88_words(await self.send_command("getS88(" + str(count) + ")"), count)
+
+    async def updateS88b(self, count = None):
+        words = await self.getS88Words(count or len(self.s88b))
+        if words is None:
+            return False
+        self._publish_s88(words)
+        return True
+
+    # 新しい S88 の状態を反映して、ビットが立った待ちだけを起こす。
+    def _publish_s88(self, words):
+        now = time.monotonic()
+        self.s88_edges.push_diff(now, self.s88b, words)
+        self.s88b[:len(words)] = words
+        self.s88_updated_at = now
+        for key in [k for k in self._bit_waiters if self.readS88b(*k)]:
+            for future in self._bit_waiters.pop(key):
+                if not future.done():
+                    future.set_result(now)      # 真になる値として、読んだ時刻を渡す
+
+    # S88 のビットの変化を受け取る読み手を作る。async for edge in ds.subscribe_s88_edges(): で使う。
+    def subscribe_s88_edges(self):
+        return self.s88_edges.subscribe()
+
+    # ポーリングの開始・停止を待っているコルーチンに知らせる。
+    def _wake_all_waiters(self):
+        for futures in self._bit_waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_result(False)
+        self._bit_waiters.clear()
+
+    def readS88b(self, count, num):
+        return bool((self.s88b[count - 1] >> (num - 1)) & 1)
+
+    # count 個目の S88 装置の num番目のビットがHになるのを待つ。待っている間はタイマーも動かない。
+    async def waitForS88(self, count, num, timeout = 60, raise_on_timeout = False):
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            if not self.polling_s88_en:
+                await self.updateS88b()
+            arrived = self.readS88b(count, num) and self.s88_updated_at
+            remaining = deadline - time.monotonic()
+            if arrived or remaining <= 0:
+                break
+            future = self._loop.create_future()
+            if not any(k[0] == count for k in self._bit_waiters) and self._poll_wake is not None:
+                self._poll_wake.set()           # 見る装置が増えたのでポーリングを起こす
+            self._bit_waiters.setdefault((count, num), []).append(future)
+            try:
+                arrived = await asyncio.wait_for(future, remaining if self.polling_s88_en else min(remaining, 0.1))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiters = self._bit_waiters.get((count, num))
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._bit_waiters[(count, num)]
+            if arrived:
+                break
+        result = S88WaitResult(count, num, bool(arrived), time.monotonic() - start, arrived or None)
+        if not arrived and raise_on_timeout:
+            raise S88Timeout(result)
+        return result
+
+    wait_for_s88 = waitForS88
+
+    # DesktopStation.polling_s88 と同じく、開始時刻から interval 刻みの時刻に読む。間に合わなかった時刻は飛ばす。
+    # idle_interval を指定したときは、waitForS88 で待たれている装置までを interval で、全装置を idle_interval で読む。
+    async def _polling_s88(self):
+        next_all = time.monotonic() + self._all_interval(0)
+        next_fast = None
+        while self.polling_s88_en:
+            self._poll_wake.clear()
+            units = self._watched_units()
+            now = time.monotonic()
+            if not units:
+                next_fast = None
+            elif next_fast is None:
+                next_fast = now
+                next_all = min(next_all, now + self._all_interval(units))
+            deadline = next_all if next_fast is None else min(next_all, next_fast)
+            try:
+                await asyncio.wait_for(self._poll_wake.wait(), max(0.0, deadline - now))
+                continue
+            except asyncio.TimeoutError:
+                pass
+            if next_fast is None or next_all <= next_fast:
+                await self.updateS88b()
+                if next_fast is not None:
+                    next_fast = max(next_fast, next_all + self.polling_interval)
+                next_all = self._next_poll(next_all, self._all_interval(units))
+            else:
+                await self.updateS88b(units)
+                next_fast = self._next_poll(next_fast, self.polling_interval)
+
+    def _watched_units(self):
+        if self.idle_interval is None:
+            return 0
+        return min(max((k[0] for k in self._bit_waiters), default = 0), len(self.s88b))
+
+    def _all_interval(self, units):
+        if self.idle_interval is None:
+            return self.polling_interval
+        if units or self.heartbeat_interval is None:
+            return self.idle_interval
+        return self.heartbeat_interval
+
+    def _next_poll(self, at, interval):
+        at += interval
+        now = time.monotonic()
+        if now >= at:
+            missed = int((now - at) // interval) + 1
+            at += missed * interval
+            self.poll_overruns += missed
+        return at
+
+    # 引数は DesktopStation.start_polling_s88 と同じ。
+    async def start_polling_s88(self, interval = 0.1, idle_interval = None, heartbeat_interval = None):
+        if self.polling_s88_en:
+            await self.stop_polling_s88()
+        s88_log.info("S88 POLLING_START")
+        self.polling_interval = interval
+        self.idle_interval = idle_interval
+        self.heartbeat_interval = heartbeat_interval
+        self._poll_wake = asyncio.Event()
+        self.polling_s88_en = True
+        await self.updateS88b()
+        self._wake_all_waiters()
+        self._poll_task = self._loop.create_task(self._polling_s88())
+
+    async def stop_polling_s88(self):
+        self.polling_s88_en = False
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+        self._wake_all_waiters()
+        s88_log.info("S88 POLLING_STOP")
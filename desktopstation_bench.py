@@ -0,0 +1,195 @@
+'''
+desktopstation_bench.py
+Description: desktopstation.py の性能を疑似装置 (desktopstation_emulator.py) を相手に測ります。
+send_command, polling_s88, waitForS88 などを変えたときに、速くなったか遅くなったかを比べるためのものです。
+結果は JSON で出力するので、リリースごとに保存して比較できます。
+
+測るもの:
+    throughput      コマンドの種類ごとの、連続して送ったときの 1 秒あたりのコマンド数
+    stop_latency    S88 のビットが H になってから setLocoSpeed(addr, 0) が疑似装置に届くまでの時間の分布
+    wake_latency    S88 の状態を更新してから waitForS88 で待っているスレッドが起きるまでの時間 (スレッド数 1～64)
+    s88_update      S88 装置の数ごとの updateS88b 1回の時間と、装置1つ増えるごとの増分
+
+使い方:
+    python desktopstation_bench.py [--quick] [--output bench.json] [--latency 0.003] [--pipeline 1] [--gap loco=0.1]
+'''
+
+import os, json, time, platform, argparse, threading, contextlib, subprocess
+import desktopstation, desktopstation_emulator
+
+# 値のリストを統計値にまとめる。
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+    return {'count': len(values), 'mean': sum(values) / len(values), 'min': values[0],
+            'p50': pct(50), 'p90': pct(90), 'p99': pct(99), 'max': values[-1]}
+
+# 疑似装置と、それにつないだ DesktopStation を用意する。
+@contextlib.contextmanager
+def station(opt, s88_count = 1):
+    emu = desktopstation_emulator.DesktopStationEmulator(s88_count, opt.latency, opt.jitter, opt.line_gap, seed = 1)
+    emu.start()
+    ds = desktopstation.DesktopStation(s88_count, pipeline = opt.pipeline, pacing = desktopstation.Pacing(min_gap = opt.gap))
+    try:
+        if not ds.open(emu.port):
+            raise RuntimeError("cannot open the emulator")
+        ds.setPower(1)
+        yield emu, ds
+    finally:
+        if ds.polling_s88_en:
+            ds.stop_polling_s88()
+        ds.close()
+        emu.stop()
+
+# 種類ごとのコマンドを n 個まとめて積んで、全部の応答が返るまでの時間を測る。
+def bench_throughput(opt):
+    commands = {
+        'loco': lambda i: "setLocoSpeed(%d,%d,0)" % (0xC000 + 1 + i % 100, 100 + i % 2),
+        'turnout': lambda i: "setTurnout(%d,%d)" % (0x3800 + i % 100, i % 2),
+        's88': lambda i: "getS88(1)",
+        'cv': lambda i: "getLocoConfig(%d,%d)" % (0xC000 + 3, 1 + i % 8),
+        'system': lambda i: "setPing()",
+    }
+    results = {}
+    with station(opt) as (emu, ds):
+        for cls, make in commands.items():
+            n = opt.commands
+            start = time.monotonic()
+            futures = [ds.submit_command(make(i), force = True) for i in range(n)]
+            replies = [f.result() for f in futures]
+            elapsed = time.monotonic() - start
+            results[cls] = {'commands': n, 'seconds': elapsed, 'commands_per_second': n / elapsed,
+                            'errors': sum(1 for r in replies if not r or '200 Ok' not in r)}
+    return results
+
+# S88 のビットが H になってから、待っていた列車の停車コマンドが疑似装置に届くまで。
+def bench_stop_latency(opt):
+    latencies = []
+    misses = 0
+    with station(opt) as (emu, ds):
+        ds.start_polling_s88(opt.poll_interval)
+        target = "setLocoSpeed(%d,0,0)" % (0xC000 + 3)
+        for _ in range(opt.trials):
+            def train():
+                if ds.waitForS88(1, 1, timeout = 5):
+                    ds.setLocoSpeed(3, 0, force = True)
+            th = threading.Thread(target = train)
+            th.start()
+            time.sleep(opt.poll_interval * 2)
+            t0 = time.monotonic()
+            emu.set_s88(1, 1, True)
+            th.join()
+            sent = [t for t, c in list(emu.commands) if t >= t0 and c == target]
+            if sent:
+                latencies.append(sent[0] - t0)
+            else:
+                misses += 1
+            emu.set_s88(1, 1, False)
+            while ds.readS88b(1, 1):
+                time.sleep(opt.poll_interval / 4)
+    result = summarize(latencies)
+    result['misses'] = misses
+    result['poll_interval'] = opt.poll_interval
+    return result
+
+# S88 の状態が更新されてから、同じビットを待っている n 個のスレッドが起きるまで。
+def bench_wake_latency(opt):
+    results = {}
+    with station(opt) as (emu, ds):
+        ds.start_polling_s88(opt.poll_interval)
+        for n in opt.threads:
+            latencies = []
+            for _ in range(max(1, opt.trials // 5)):
+                woke = []
+                def waiter():
+                    r = ds.waitForS88(1, 2, timeout = 5)
+                    if r:
+                        woke.append(time.monotonic() - r.time)     # 自分を起こした S88 を読んだ時刻から
+                threads = [threading.Thread(target = waiter) for _ in range(n)]
+                for th in threads:
+                    th.start()
+                time.sleep(opt.poll_interval * 2)
+                emu.set_s88(1, 2, True)
+                for th in threads:
+                    th.join()
+                latencies += woke
+                emu.set_s88(1, 2, False)
+                while ds.readS88b(1, 2):
+                    time.sleep(opt.poll_interval / 4)
+            results[str(n)] = summarize(latencies)
+    return results
+
+# S88 装置の数を変えて updateS88b 1回の時間を測る。
+def bench_s88_update(opt):
+    per_units = {}
+    for units in range(1, opt.max_units + 1):
+        with station(opt, units) as (emu, ds):
+            ds.updateS88b()                     # setPower の後のウェイトを含めないように1回読んでおく
+            times = []
+            for _ in range(opt.repeat):
+                start = time.monotonic()
+                ds.updateS88b()
+                times.append(time.monotonic() - start)
+            per_units[str(units)] = summarize(times)
+    xs = [int(k) for k in per_units]
+    ys = [v['mean'] for v in per_units.values()]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    den = sum((x - mx) ** 2 for x in xs)
+    slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / den if den else 0.0
+    return {'units': per_units, 'seconds_per_additional_unit': slope}
+
+BENCHMARKS = {'throughput': bench_throughput, 'stop_latency': bench_stop_latency,
+              'wake_latency': bench_wake_latency, 's88_update': bench_s88_update}
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _gap(text):
+    cls, _, seconds = text.partition('=')
+    return cls, float(seconds)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "desktopstation benchmarks against the pty emulator")
+    parser.add_argument('--output', help = "write JSON here instead of stdout")
+    parser.add_argument('--only', action = 'append', choices = sorted(BENCHMARKS), help = "run only these benchmarks")
+    parser.add_argument('--quick', action = 'store_true', help = "fewer commands and trials")
+    parser.add_argument('--latency', type = float, default = 0.003, help = "emulator reply latency [s]")
+    parser.add_argument('--jitter', type = float, default = 0.001, help = "emulator reply jitter [s]")
+    parser.add_argument('--line-gap', type = float, default = 0.006, help = "emulator gap between reply lines [s]")
+    parser.add_argument('--pipeline', type = int, default = 1)
+    parser.add_argument('--gap', type = _gap, action = 'append', default = [], help = "minimum gap per command class, e.g. loco=0.05")
+    parser.add_argument('--poll-interval', type = float, default = 0.1)
+    parser.add_argument('--commands', type = int, default = 50, help = "commands per class for throughput")
+    parser.add_argument('--trials', type = int, default = 30)
+    parser.add_argument('--threads', type = int, nargs = '+', default = [1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--max-units', type = int, default = 8)
+    parser.add_argument('--repeat', type = int, default = 20)
+    opt = parser.parse_args(argv)
+    opt.gap = dict(opt.gap)
+    if opt.quick:
+        opt.commands, opt.trials, opt.repeat, opt.max_units = 10, 5, 5, 4
+        opt.threads = [1, 8, 64]
+
+    report = {'revision': _revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'settings': {k: v for k, v in vars(opt).items() if k not in ('output', 'only')},
+              'results': {}}
+    for name in opt.only or BENCHMARKS:
+        report['results'][name] = BENCHMARKS[name](opt)
+    text = json.dumps(report, indent = 2)
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+desktopstation_cv.py
+Description: デコーダの CV をまとめて読み書きするためのものです。
+読み書きするコマンドを全部キューに積んでおくと、DesktopStation の Pacing の 'cv' の間隔で続けて送られるので、
+1つずつ send_command で応答を待つよりずっと早く終わります。@CV の応答は数にして返します。
+読めなかった・書けなかったものは retries 回までやり直し、それでもだめなものは failed に残ります。
+読んだ値と書いた値は機関車アドレスごとにファイル (JSON) に保存するので、一度読んだデコーダは
+もう一度読まなくても値が分かります。途中で失敗しても、次は読めていない CV だけを読みます。
+
+使い方:
+    cv = CVProgrammer(ds, 'cv_cache.json')
+    result = cv.read(3, range(1, 30))           # 機関車 3 番の CV1～29 (保存してあるものは読まない)
+    print(result.values[3][29], result.failed)
+    cv.write(3, {3: 10, 4: 10})                 # CV3, CV4 に 10 を書く
+    cv.run([(3, 1), (5, 1), (5, 29, 6)])        # 読み (アドレス, CV) と書き (アドレス, CV, 値) を混ぜて
+'''
+
+import os, json, logging, threading
+import desktopstation
+
+log = logging.getLogger('desktopstation.cv')
+
+# run の結果。values は {アドレス: {CV番号: 値}} (読んだものと書いたもの、保存してあったもの)。
+# failed はやり直してもだめだった操作 (run に渡した形のタプル) のリスト。
+class CVResult:
+    def __init__(self):
+        self.values = {}
+        self.failed = []
+        self.cached = 0                 # 保存してあった値を使った数
+        self.commands = 0               # 送ったコマンドの数
+
+    def __bool__(self):
+        return not self.failed
+
+    def __repr__(self):
+        return "CVResult(values=%r, failed=%r, cached=%d, commands=%d)" % (self.values, self.failed, self.cached, self.commands)
+
+class CVProgrammer:
+    # cache_path を省略すると保存しない。retries は失敗した操作をやり直す回数。
+    def __init__(self, ds, cache_path = None, retries = 2):
+        self.ds = ds
+        self.cache_path = cache_path
+        self.retries = retries
+        self._lock = threading.Lock()
+        self.cache = {}                 # アドレス -> {CV番号: 値}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, encoding = 'utf-8') as f:
+                self.cache = {int(a): {int(n): v for n, v in cvs.items()} for a, cvs in json.load(f).items()}
+
+    def cached(self, addr, num):
+        return self.cache.get(addr, {}).get(num)
+
+    # 保存してある値を忘れる。num を省略するとそのアドレスの全部。(デコーダを載せ替えたときなど)
+    def forget(self, addr, num = None):
+        with self._lock:
+            if num is None:
+                self.cache.pop(addr, None)
+            else:
+                self.cache.get(addr, {}).pop(num, None)
+        self.save()
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        with self._lock:
+            data = {str(a): {str(n): v for n, v in sorted(cvs.items())} for a, cvs in sorted(self.cache.items())}
+        tmp = self.cache_path + '.tmp'
+        with open(tmp, 'w', encoding = 'utf-8') as f:
+            json.dump(data, f, indent = 1)
+        os.replace(tmp, self.cache_path)    # 書いている途中で止まっても前のファイルが残る
+
+    # 機関車 addr の CV (番号のリスト) を読む。refresh = True なら保存してある値も読み直す。
+    def read(self, addr, nums, refresh = False):
+        return self.run([(addr, n) for n in nums], refresh)
+
+    # 機関車 addr の CV に書く。values は {CV番号: 値}。
+    def write(self, addr, values):
+        return self.run([(addr, n, v) for n, v in values.items()])
+
+    # ops は (アドレス, CV番号) の読みと (アドレス, CV番号, 値) の書きのリスト。
+    # 全部を一度にキューに積んで、応答を順に集める。失敗したものだけを積み直す。
+    def run(self, ops, refresh = False):
+        result = CVResult()
+        todo = []
+        for op in ops:
+            if len(op) == 2 and not refresh and self.cached(*op) is not None:
+                result.values.setdefault(op[0], {})[op[1]] = self.cached(*op)
+                result.cached += 1
+            else:
+                todo.append(tuple(op))
+        for attempt in range(self.retries + 1):
+            if not todo:
+                break
+            if attempt:
+                log.info("CV RETRY %d ops (attempt %d)", len(todo), attempt + 1)
+            futures = [(op, self._submit(op)) for op in todo]
+            result.commands += len(futures)
+            todo = []
+            for op, future in futures:
+                value = self._collect(op, future)
+                if value is None:
+                    todo.append(op)
+                else:
+                    result.values.setdefault(op[0], {})[op[1]] = value
+                    with self._lock:
+                        self.cache.setdefault(op[0], {})[op[1]] = value
+            self.save()                 # 途中で止まっても、ここまでの分は次に読まなくてよい
+        result.failed = todo
+        if todo:
+            log.warning("CV FAILED %r", todo)
+        return result
+
+    def _submit(self, op):
+        if len(op) == 2:
+            return self.ds.getLocoConfig(op[0], op[1], wait = False)
+        return self.ds.setLocoConfigValue(op[0], op[1], op[2], wait = False)
+
+    # 読みなら値、書きなら書いた値。失敗なら None。
+    # 読んだ値は、応答のアドレスと CV 番号が op と同じときだけ使う。(違う値を保存しない)
+    def _collect(self, op, future):
+        try:
+            rcv = future.result()
+        except Exception as e:
+            log.warning("CV ERROR %r %s", op, e)
+            return None
+        if len(op) == 2:
+            return desktopstation.DesktopStation._parse_cv(rcv, 0xC000 + op[0], op[1])
+        return op[2] if rcv and '200 Ok' in rcv else None
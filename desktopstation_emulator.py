@@ -0,0 +1,274 @@
+'''
+desktopstation_emulator.py
+Description: DesktopStation (DS Air) の疑似装置です。Linux の疑似端末(pty)を開いて、
+実機の代わりにシリアルコマンドに応答します。実機や線路が無くても、ライブラリやサンプルプログラムを
+動かしたり、速度を測ったりできます。
+応答の遅れとばらつきは latency, jitter で指定します。S88 の入力は set_s88() で直接変えるか、
+TrackModel のような列車の模型を model に渡して、機関車の速度に合わせて動かします。
+
+使い方:
+    emu = DesktopStationEmulator()
+    emu.start()
+    ds = desktopstation.DesktopStation()
+    ds.open(emu.port)       # COM3 の代わりに emu.port (/dev/pts/N) を開く
+    ...
+    emu.stop()
+
+コマンドラインから起動すると、開いた端末の名前を表示して Ctrl-C まで応答し続けます。
+    python desktopstation_emulator.py [--latency 0.003] [--jitter 0.001] [--s88 1]
+'''
+
+import os, re, tty, time, fcntl, heapq, random, select, struct, termios, threading
+
+# 応答コード。200 以外はエラーとして扱われる。
+READY = '100 Ready'
+OK = '200 Ok'
+ERR_COMMAND = '300 Command error'   # 知らないコマンド
+ERR_SYNTAX = '301 Syntax error'     # 引数がおかしい
+
+_COMMAND_RE = re.compile(r'^(\w+)\(([^)]*)\)$')
+
+class DesktopStationEmulator:
+    # s88_count は S88 装置の数。latency は応答までの秒数、jitter はそのばらつき(±秒)。
+    # line_gap は応答が複数行のときの行の間隔 (実機は 6ms くらい)。
+    # model は tick 秒ごとに model.step(emulator, dt) が呼ばれる列車の模型。
+    def __init__(self, s88_count = 1, latency = 0.003, jitter = 0.0, line_gap = 0.006, model = None, tick = 0.02, seed = None):
+        self.s88_count = s88_count
+        self.latency = latency
+        self.jitter = jitter
+        self.line_gap = line_gap
+        self.model = model
+        self.tick = tick
+        self.port = None                # クライアントが開く端末の名前
+        self.commands = []              # 受けたコマンドの記録 (time.monotonic(), コマンド文字列)
+        self.hooks = []                 # コマンドを受けるたびに fn(emulator, name, args) を呼ぶ
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._s88 = [0] * s88_count
+        self._master = None
+        self._thread = None
+        self._running = False
+        self.reset()
+
+    # 電源を入れ直したときの状態に戻す。(S88 の入力はそのまま)
+    def reset(self):
+        with self._lock:
+            self.power = 0
+            self.speed = {}             # 機関車アドレス(0xC000 を引いた値) -> 速度
+            self.direction = {}         # 機関車アドレス -> 1 or 2
+            self.functions = {}         # (機関車アドレス, ファンクション番号) -> 0/1
+            self.turnouts = {}          # ポイントアドレス(1始まり) -> 方向
+            self.cv = {}                # (機関車アドレス, CV 番号) -> 値
+
+    def start(self):
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        os.close(slave)                 # 開いている者がいないと POLLHUP になるので、閉じられたことが分かる
+        # パケットモードにすると、クライアントが開いたときの受信バッファのクリア(pyserial の open が行う)が
+        # TIOCPKT_FLUSHREAD として読めるので、それを実機のリセットとみなす。
+        fcntl.ioctl(self._master, termios.TIOCPKT, struct.pack('i', 1))
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="DS-EMU", daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._master is not None:
+            os.close(self._master)
+            self._master = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # count 個目の S88 装置の num 番目のビットを変える。(どちらも1始まり)
+    def set_s88(self, count, num, on):
+        with self._lock:
+            if on:
+                self._s88[count - 1] |= 1 << (num - 1)
+            else:
+                self._s88[count - 1] &= ~(1 << (num - 1))
+
+    # S88 のビットを duration 秒だけ H にする。
+    def pulse_s88(self, count, num, duration = 0.2):
+        self.set_s88(count, num, True)
+        threading.Timer(duration, self.set_s88, (count, num, False)).start()
+
+    def get_s88(self, count):
+        with self._lock:
+            return self._s88[count - 1]
+
+    def _run(self):
+        opened = False
+        rx = b''
+        replies = []                    # (送る時刻, 連番, 行) のヒープ
+        seq = 0
+        busy_until = 0.0                # 前のコマンドの応答が終わる時刻。コマンドは1つずつ処理する。
+        next_tick = time.monotonic() + self.tick
+        poller = select.poll()
+        poller.register(self._master, select.POLLIN)
+        while self._running:
+            now = time.monotonic()
+            deadline = now + 0.05
+            if replies:
+                deadline = min(deadline, replies[0][0])
+            if self.model is not None:
+                deadline = min(deadline, next_tick)
+            events = poller.poll(max(0.0, deadline - now) * 1000)
+            now = time.monotonic()
+            if any(e & select.POLLHUP for _, e in events):
+                if opened:              # クライアントが閉じた
+                    opened = False
+                    rx = b''
+                    replies = []
+                time.sleep(0.01)
+                continue
+            if any(e & select.POLLIN for _, e in events):
+                try:
+                    packet = os.read(self._master, 4097)
+                except OSError:
+                    continue
+                if packet[0] & termios.TIOCPKT_FLUSHREAD:   # クライアントが開いた。実機はここでリセットされる。
+                    opened = True
+                    rx = b''
+                    replies = []
+                    self.reset()
+                    busy_until = now + 0.05
+                    heapq.heappush(replies, (busy_until, seq, READY))
+                    seq += 1
+                elif packet[0] == termios.TIOCPKT_DATA:
+                    rx += packet[1:]
+                while b'\r\n' in rx:
+                    line, rx = rx.split(b'\r\n', 1)
+                    command = line.decode(errors = 'replace').strip()
+                    if not command:
+                        continue
+                    at = max(now, busy_until) + max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+                    for i, reply in enumerate(self.handle(command)):
+                        heapq.heappush(replies, (at + i * self.line_gap, seq, reply))
+                        seq += 1
+                        busy_until = at + i * self.line_gap
+            while replies and replies[0][0] <= now:
+                self._write(heapq.heappop(replies)[2])
+            if self.model is not None and now >= next_tick:
+                dt = self.tick + (now - next_tick)
+                next_tick = now + self.tick
+                self.model.step(self, dt)
+
+    def _write(self, line):
+        try:
+            os.write(self._master, (line + '\r\n').encode())
+        except OSError:
+            pass                        # 閉じられていたら捨てる
+
+    # 1行のコマンドを処理して、返す行のリストを返す。
+    def handle(self, command):
+        self.commands.append((time.monotonic(), command))
+        m = _COMMAND_RE.match(command)
+        if m is None:
+            return [ERR_SYNTAX]
+        name = m.group(1)
+        try:
+            args = [int(a) for a in m.group(2).split(',') if a.strip() != '']
+        except ValueError:
+            return [ERR_SYNTAX]
+        handler = getattr(self, '_cmd_' + name, None)
+        if handler is None:
+            return [ERR_COMMAND]
+        with self._lock:
+            try:
+                replies = handler(*args)
+            except (TypeError, IndexError):
+                return [ERR_SYNTAX]
+        for fn in self.hooks:
+            fn(self, name, args)
+        return replies
+
+    def _cmd_setPing(self):
+        return [OK]
+
+    def _cmd_setPower(self, on):
+        self.power = on
+        return [OK]
+
+    def _cmd_setLocoSpeed(self, addr, speed, speed_step = 0):
+        self.speed[addr - 0xC000] = speed
+        return [OK]
+
+    def _cmd_setLocoDirection(self, addr, dir):
+        self.direction[addr - 0xC000] = dir
+        return [OK]
+
+    def _cmd_setLocoFunction(self, addr, num, on):
+        self.functions[(addr - 0xC000, num)] = on
+        return [OK]
+
+    # 引数が2つの形 (アドレス, 値) と3つの形 (アドレス, CV 番号, 値) を受け付ける。
+    def _cmd_setLocoConfig(self, addr, *args):
+        if len(args) == 2:
+            self.cv[(addr - 0xC000, args[0])] = args[1]
+        elif len(args) != 1:
+            raise TypeError
+        return [OK]
+
+    def _cmd_getLocoConfig(self, addr, num):
+        value = self.cv.get((addr - 0xC000, num), 0)
+        return ['@CV,%d,%d,%d,' % (addr, num, value), OK]
+
+    def _cmd_setTurnout(self, addr, dir):
+        self.turnouts[addr - 0x3800 + 1] = dir
+        return [OK]
+
+    def _cmd_getS88(self, count):
+        if not 1 <= count <= self.s88_count:
+            raise IndexError
+        return ['@S88,' + ''.join('%04X,' % w for w in self._s88[:count]), OK]
+
+# 1周 length の線路に S88 のセンサを並べた、簡単な列車の模型。
+# 機関車の速度 1 あたり speed_scale [長さ/秒] で進み、センサの位置から ±sensor_width の範囲に
+# 列車がいる間だけそのビットが H になる。方向 2 で正の向き、1 で負の向きに進む。
+class TrackModel:
+    def __init__(self, length, sensors, speed_scale = 0.001, sensor_width = 0.05):
+        self.length = length
+        self.sensors = sensors          # [(位置, S88 装置番号, ビット番号), ...]
+        self.speed_scale = speed_scale
+        self.sensor_width = sensor_width
+        self.position = {}              # 機関車アドレス -> 位置
+
+    def place(self, addr, position):
+        self.position[addr] = position % self.length
+
+    def step(self, emulator, dt):
+        power = emulator.power
+        for addr in self.position:
+            speed = emulator.speed.get(addr, 0) if power else 0
+            sign = 1 if emulator.direction.get(addr, 2) == 2 else -1
+            self.position[addr] = (self.position[addr] + sign * speed * self.speed_scale * dt) % self.length
+        for pos, count, num in self.sensors:
+            hit = any(min(abs(p - pos), self.length - abs(p - pos)) <= self.sensor_width for p in self.position.values())
+            emulator.set_s88(count, num, hit)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = "DesktopStation emulator on a pseudo terminal")
+    parser.add_argument('--latency', type = float, default = 0.003)
+    parser.add_argument('--jitter', type = float, default = 0.0)
+    parser.add_argument('--s88', type = int, default = 1, help = "number of S88 units")
+    opt = parser.parse_args()
+    emu = DesktopStationEmulator(opt.s88, opt.latency, opt.jitter)
+    print("DS EMULATOR:", emu.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emu.stop()
@@ -0,0 +1,343 @@
+'''
+desktopstation_gateway.py
+Description: 1つの DesktopStation (シリアルポート) を、TCP や WebSocket でつないだ複数のプログラムから
+同時に使うためのゲートウェイです。COM3 を開けるのは1つのプロセスだけなので、指令画面・自動運転・音声などの
+プログラムはこのゲートウェイにつなぎます。
+
+コマンドは DesktopStation と同じ文字列を1行ずつ送ります (例: setLocoSpeed(49155,100,0))。
+応答も DesktopStation と同じ行 (@CV,... や 200 Ok) が、送った順に返ります。
+シリアルが空くと、コマンドが待っているクライアントから順番に1つずつ取り出して送るので、
+たくさん送るクライアントがいても、ほかのクライアントのコマンドが後回しにされ続けることはありません。
+送信間隔は DesktopStation の Pacing のまま、停車コマンドの優先も DesktopStation のままです。
+
+ゲートウェイのコマンド:
+    subscribe()     S88 の今の状態 (@S88,...) を返し、以後ビットが変わるたびに @EDGE,装置番号,ビット番号,値 を送る
+    unsubscribe()   @EDGE を止める
+ゲートウェイの応答:
+    500 Not connected   DesktopStation につながっていない
+    500 No reply        DesktopStation から応答が無かった
+
+使い方:
+    python desktopstation_gateway.py --port COM3 [--listen 127.0.0.1:50200] [--ws 50201]
+    (TCP なら telnet 127.0.0.1 50200 などで試せる)
+'''
+
+import re, base64, asyncio, hashlib, logging, argparse, collections
+import desktopstation
+
+log = logging.getLogger('desktopstation.gateway')
+
+NOT_CONNECTED = '500 Not connected'
+NO_REPLY = '500 No reply'
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_MAX_LINE = 64 * 1024                   # 1行 (1メッセージ) の最大の長さ。StreamReader の limit と同じ
+_COMMAND_RE = re.compile(r'^(\w+)\(([^)]*)\)$')
+
+# TCP でつないだクライアント。1行が1コマンド。
+class _TcpTransport:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.name = '%s:%s' % writer.get_extra_info('peername')[:2]
+
+    async def read_line(self):
+        line = await self.reader.readline()
+        return None if not line else line.decode(errors = 'replace').strip()
+
+    def write(self, text):
+        self.writer.write(text.encode())
+
+    # 送り切れずにたまっているバイト数。
+    def buffered(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    async def drain(self):
+        await self.writer.drain()
+
+    # たまっているものを捨てて切る。(読まないクライアントを切るとき)
+    def abort(self):
+        self.writer.transport.abort()
+
+    async def close(self):
+        self.writer.close()
+
+# WebSocket (RFC 6455) でつないだクライアント。テキストのメッセージ1つが1コマンド (改行で区切ってもよい)。
+# ブラウザの指令画面から使えるように、必要な分だけを標準ライブラリで実装している。
+class _WsTransport(_TcpTransport):
+    def __init__(self, reader, writer):
+        super().__init__(reader, writer)
+        self._lines = collections.deque()
+
+    async def handshake(self):
+        request = await self.reader.readuntil(b'\r\n\r\n')
+        headers = {}
+        for line in request.decode(errors = 'replace').split('\r\n')[1:]:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        if key is None or 'websocket' not in headers.get('upgrade', '').lower():
+            self.writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            return False
+        accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+        self.writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                           'Sec-WebSocket-Accept: %s\r\n\r\n' % accept).encode())
+        return True
+
+    async def _read_frame(self):
+        head = await self.reader.readexactly(2)
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = int.from_bytes(await self.reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await self.reader.readexactly(8), 'big')
+        if length > _MAX_LINE:
+            raise ValueError("WebSocket message too long (%d bytes)" % length)
+        mask = await self.reader.readexactly(4) if head[1] & 0x80 else None
+        data = bytearray(await self.reader.readexactly(length))
+        if mask is not None:
+            for i in range(length):
+                data[i] ^= mask[i % 4]
+        return opcode, bytes(data)
+
+    async def read_line(self):
+        while not self._lines:
+            try:
+                opcode, data = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return None
+            if opcode == 0x8:           # close
+                self._send_frame(0x8, data[:2])
+                return None
+            if opcode == 0x9:           # ping
+                self._send_frame(0xA, data)
+            elif opcode in (0x1, 0x2):  # text, binary (分割されたメッセージは使わない)
+                self._lines.extend(l.strip() for l in data.decode(errors = 'replace').splitlines())
+        return self._lines.popleft()
+
+    def write(self, text):
+        self._send_frame(0x1, text.encode())
+
+    def _send_frame(self, opcode, payload):
+        n = len(payload)
+        if n < 126:
+            head = bytes([0x80 | opcode, n])
+        elif n < 65536:
+            head = bytes([0x80 | opcode, 126]) + n.to_bytes(2, 'big')
+        else:
+            head = bytes([0x80 | opcode, 127]) + n.to_bytes(8, 'big')
+        self.writer.write(head + payload)
+
+# つないでいるクライアント1つ分。
+class _Client:
+    def __init__(self, transport):
+        self.transport = transport
+        self.name = transport.name
+        self.pending = collections.deque()  # まだシリアルに積んでいない (コマンド, future)
+        self.replies = asyncio.Queue()      # 送った順の応答の future
+        self.subscribed = False
+        self.commands = 0
+
+class Gateway:
+    # ds は open 済みの DesktopStation。window はシリアルに同時に積んでおくコマンドの数。
+    # 小さいほど公平になり、大きいほど DesktopStation の pipeline を活かせる。
+    # max_buffer は読まないクライアントに送れずにたまってよいバイト数。超えたらそのクライアントを切る。
+    def __init__(self, ds, host = '127.0.0.1', port = 50200, ws_port = None, window = 2, max_buffer = 256 * 1024):
+        self.ds = ds
+        self.host = host
+        self.port = port
+        self.ws_port = ws_port
+        self.window = window
+        self.max_buffer = max_buffer
+        self.clients = []
+        self._ready = collections.deque()   # コマンドが待っているクライアント (順番に取り出す)
+        self._outstanding = 0
+        self._wakeup = None
+        self._servers = []
+        self._tasks = []
+        self._handlers = set()              # クライアントごとのタスク
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._servers.append(await asyncio.start_server(self._on_tcp, self.host, self.port))
+        if self.ws_port is not None:
+            self._servers.append(await asyncio.start_server(self._on_ws, self.host, self.ws_port))
+        self._tasks = [loop.create_task(self._schedule()), loop.create_task(self._push_edges())]
+        log.info("GATEWAY LISTEN %s:%s%s", self.host, self.port, '' if self.ws_port is None else ' ws:%s' % self.ws_port)
+
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        handlers = list(self._handlers)     # つながっているクライアントを切る
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions = True)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def _on_tcp(self, reader, writer):
+        await self._serve(_TcpTransport(reader, writer))
+
+    async def _on_ws(self, reader, writer):
+        transport = _WsTransport(reader, writer)
+        try:
+            ok = await transport.handshake()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            ok = False
+        if ok:
+            await self._serve(transport)
+        else:
+            writer.close()
+
+    async def _serve(self, transport):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            await self._serve_client(transport)
+        except asyncio.CancelledError:
+            pass                        # stop() で切った
+        finally:
+            self._handlers.discard(task)
+
+    async def _serve_client(self, transport):
+        client = _Client(transport)
+        self.clients.append(client)
+        log.info("GATEWAY CONNECT %s", client.name)
+        writer = asyncio.get_running_loop().create_task(self._write_replies(client))
+        try:
+            while True:
+                line = await transport.read_line()
+                if line is None:
+                    break
+                if line:
+                    self._on_line(client, line)
+        except (ValueError, asyncio.LimitOverrunError) as e:
+            log.warning("GATEWAY LINE_TOO_LONG %s %s", client.name, e)     # 長すぎる行を送ってきたら切る
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.remove(client)
+            for _, future in client.pending:
+                future.cancel()
+            client.pending.clear()
+            writer.cancel()
+            await transport.close()
+            log.info("GATEWAY DISCONNECT %s (%d commands)", client.name, client.commands)
+
+    def _on_line(self, client, line):
+        future = asyncio.get_running_loop().create_future()
+        client.replies.put_nowait(future)
+        m = _COMMAND_RE.match(line)
+        name = m.group(1) if m else None
+        if name == 'subscribe':
+            client.subscribed = True
+            future.set_result('@S88,' + ''.join('%04X,' % w for w in self.ds.s88b) + '\r\n200 Ok\r\n')
+        elif name == 'unsubscribe':
+            client.subscribed = False
+            future.set_result('200 Ok\r\n')
+        else:
+            client.commands += 1
+            if not client.pending:
+                self._ready.append(client)
+            client.pending.append((line, future))
+            self._wakeup.set()
+
+    # 応答を、コマンドを受けた順にクライアントへ返す。
+    async def _write_replies(self, client):
+        while True:
+            future = await client.replies.get()
+            try:
+                text = await future
+            except asyncio.CancelledError:
+                return
+            client.transport.write(text)
+            try:
+                await client.transport.drain()      # 読まないクライアントの分を、ここで止めてためない
+            except ConnectionError:
+                return
+
+    # シリアルに空きがあれば、待っているクライアントから順番に1つずつコマンドを積む。
+    async def _schedule(self):
+        while True:
+            while self._ready and self._outstanding < self.window:
+                client = self._ready.popleft()
+                if not client.pending:          # 切断された
+                    continue
+                line, future = client.pending.popleft()
+                if client.pending:
+                    self._ready.append(client)  # 次の順番は後ろに並ぶ
+                if future.cancelled():
+                    continue
+                self._outstanding += 1
+                done = asyncio.wrap_future(self.ds.submit_command(line))
+                done.add_done_callback(lambda d, f = future: self._on_reply(d, f))
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def _on_reply(self, done, future):
+        self._outstanding -= 1
+        self._wakeup.set()
+        if future.cancelled():
+            return
+        if done.cancelled() or done.exception() is not None:
+            future.set_result(NO_REPLY + '\r\n')
+            return
+        rcv = done.result()
+        if rcv is None:                 # 状態が同じなので送らなかったか、つながっていない
+            rcv = '200 Ok\r\n' if self.ds.comm_ok else NOT_CONNECTED + '\r\n'
+        elif not rcv:
+            rcv = NO_REPLY + '\r\n'
+        future.set_result(rcv)
+
+    # S88 のビットの変化を、subscribe したクライアントに送る。
+    async def _push_edges(self):
+        async for edge in self.ds.subscribe_s88_edges():
+            line = '@EDGE,%d,%d,%d\r\n' % (edge.count, edge.num, edge.value)
+            for client in self.clients:
+                if not client.subscribed:
+                    continue
+                # 全部のクライアントに同時に送るので drain で待たず、たまりすぎたクライアントは切る
+                if client.transport.buffered() > self.max_buffer:
+                    log.warning("GATEWAY SLOW_CLIENT %s (%d bytes buffered)", client.name, client.transport.buffered())
+                    client.subscribed = False
+                    client.transport.abort()
+                    continue
+                client.transport.write(line)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "share one DesktopStation between TCP/WebSocket clients")
+    parser.add_argument('--port', default = 'COM3', help = "serial port of the DesktopStation")
+    parser.add_argument('--listen', default = '127.0.0.1:50200', help = "host:port for TCP clients")
+    parser.add_argument('--ws', type = int, default = None, help = "port for WebSocket clients")
+    parser.add_argument('--s88', type = int, default = 1, help = "number of S88 units")
+    parser.add_argument('--poll-interval', type = float, default = 0.1)
+    parser.add_argument('--pipeline', type = int, default = 1)
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO)
+    host, _, port = opt.listen.rpartition(':')
+    ds = desktopstation.DesktopStation(opt.s88, pipeline = opt.pipeline)
+    if ds.open(opt.port) == False:
+        return
+    ds.start_polling_s88(opt.poll_interval)
+    gateway = Gateway(ds, host or '127.0.0.1', int(port), opt.ws, window = max(2, opt.pipeline + 1))
+    try:
+        asyncio.run(gateway.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ds.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+'''
+desktopstation_layout.py
+Description: レイアウト(線路の配置)を宣言して、列車どうしがぶつからないように進路を予約するためのものです。
+閉塞(ブロック)ごとに S88 のセンサとポイントを、進路(ルート)ごとに通る閉塞とポイントの向きを書いておくと、
+Interlocking が進路をまとめて予約し、ポイントを一度に切り替え、列車が通り過ぎた閉塞をセンサで解放します。
+サンプルプログラムの class S88 や turnout_change_index のような、スクリプトごとの衝突よけの待ちが要らなくなります。
+
+使い方:
+    layout = Layout()
+    layout.add_block('A', [(1, 1), (1, 2)])            # 閉塞 A にはセンサ S88-1 の 1, 2 番
+    layout.add_block('B', [(1, 3)], turnouts = [1])     # 閉塞 B にはポイント 1 がある
+    layout.add_route('A-B', ['A', 'B'], {1: 0})         # A から B へはポイント 1 を 0 (直進) にする
+    il = Interlocking(ds, layout)
+    il.start()
+    r = il.reserve('A-B', train = 33)                   # 予約できるまで待って、ポイントを切り替える
+    ds.setLocoSpeed(33, 400)
+    r.wait_arrived()                                    # 最後の閉塞に入るまで待つ
+    ...
+    il.stop()
+'''
+
+import time, logging, threading
+from desktopstation import _s88_bit
+
+log = logging.getLogger('desktopstation.layout')
+
+# 閉塞。sensors はその閉塞にいる列車を検出する S88 のビット、turnouts はその閉塞の中にあるポイントの番号。
+class Block:
+    def __init__(self, name, sensors, turnouts = ()):
+        self.name = name
+        self.sensors = [_s88_bit(b) for b in sensors]
+        self.turnouts = list(turnouts)
+
+    def __repr__(self):
+        return "Block(%r, %r, %r)" % (self.name, self.sensors, self.turnouts)
+
+# 進路。blocks は通る閉塞の名前を通る順に。最初は列車がいる閉塞、最後は止まる閉塞。
+# turnouts は {ポイントの番号: 向き}。
+class Route:
+    def __init__(self, name, blocks, turnouts = None):
+        self.name = name
+        self.blocks = list(blocks)
+        self.turnouts = dict(turnouts or {})
+
+    def __repr__(self):
+        return "Route(%r, %r, %r)" % (self.name, self.blocks, self.turnouts)
+
+class Layout:
+    def __init__(self):
+        self.blocks = {}                # 名前 -> Block
+        self.routes = {}                # 名前 -> Route
+        self._block_of_bit = {}         # (装置番号, ビット番号) -> Block
+
+    def add_block(self, name, sensors, turnouts = ()):
+        block = Block(name, sensors, turnouts)
+        for bit in block.sensors:
+            if bit in self._block_of_bit:
+                raise ValueError("S88-%d bit %d is already in block %r" % (bit + (self._block_of_bit[bit].name,)))
+            self._block_of_bit[bit] = block
+        self.blocks[name] = block
+        return block
+
+    def add_route(self, name, blocks, turnouts = None):
+        for b in blocks:
+            if b not in self.blocks:
+                raise ValueError("route %r: unknown block %r" % (name, b))
+        route = self.routes[name] = Route(name, blocks, turnouts)
+        return route
+
+    # {"blocks": {名前: {"sensors": [[装置, ビット], ...], "turnouts": [...]}},
+    #  "routes": {名前: {"blocks": [...], "turnouts": {"ポイント番号": 向き}}}} の形の辞書 (JSON) から作る。
+    @classmethod
+    def from_dict(cls, data):
+        layout = cls()
+        for name, b in data.get('blocks', {}).items():
+            layout.add_block(name, [s if isinstance(s, int) else tuple(s) for s in b.get('sensors', [])], b.get('turnouts', ()))
+        for name, r in data.get('routes', {}).items():
+            layout.add_route(name, r['blocks'], {int(k): v for k, v in r.get('turnouts', {}).items()})
+        return layout
+
+    def block_of(self, count, num):
+        return self._block_of_bit.get((count, num))
+
+    # センサで列車が検出されているか。words は ds.s88b。
+    def occupied(self, name, words):
+        return any((words[c - 1] >> (n - 1)) & 1 for c, n in self.blocks[name].sensors)
+
+    def units(self):
+        return max([c for c, _ in self._block_of_bit], default = 0)
+
+# 予約した進路。列車が通り過ぎた閉塞は blocks から消えていく。
+class Reservation:
+    def __init__(self, route, train):
+        self.route = route
+        self.train = train
+        self.blocks = list(route.blocks)    # まだ持っている閉塞
+        self.entered = set()                # 列車がいることをセンサで確認した閉塞
+        self.turnouts = dict(route.turnouts)    # まだ向きを固定しているポイント
+        self.reserved_at = time.monotonic()
+        self.arrived_at = None              # 最後の閉塞に入った時刻
+        self._arrived = threading.Event()
+        self._released = threading.Event()
+
+    @property
+    def released(self):
+        return self._released.is_set()
+
+    # 列車が最後の閉塞に入るまで待つ。入ったら True。
+    def wait_arrived(self, timeout = None):
+        return self._arrived.wait(timeout)
+
+    # 閉塞が全部解放されるまで待つ。
+    def wait_released(self, timeout = None):
+        return self._released.wait(timeout)
+
+    def __repr__(self):
+        return "Reservation(%r, train=%r, blocks=%r)" % (self.route.name, self.train, self.blocks)
+
+# 進路の予約と解放を行う。予約は全部の閉塞とポイントを一度に取るか、何も取らないかのどちらか。
+# 閉塞は、列車がその先の閉塞に入っていて、センサが全部 L になったときに解放する(最後の閉塞は次の予約か release まで持つ)。
+# ポイントは、それがある閉塞を解放したとき(どの閉塞にも無いものは予約を全部解放したとき)に固定を外す。
+class Interlocking:
+    def __init__(self, ds, layout):
+        self.ds = ds
+        self.layout = layout
+        self._cv = threading.Condition()
+        self._owner = {}                # 閉塞の名前 -> Reservation
+        self._turnout_lock = {}         # ポイントの番号 -> (向き, その向きで固定している Reservation の集合)
+        self._bits = set()              # H になっている S88 のビット (変化の記録から作る)
+        self._sub = None
+        self._thread = None
+
+    # S88 の変化を見るスレッドを動かす。ポーリングは別に ds.start_polling_s88 で行うこと。
+    def start(self):
+        if self._thread is not None:
+            return
+        units = self.layout.units()
+        if units:
+            self.ds.watch_s88(units)            # 需要に合わせたポーリングのときも、レイアウトの装置は速く読む
+        self._sub = self.ds.subscribe_s88_edges()
+        with self._cv:
+            self._bits = {bit for bit in self.layout._block_of_bit if self.ds.readS88b(*bit)}
+        self._thread = threading.Thread(target=self._edge_loop, name="DS-LAYOUT", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._sub.close()
+        self._thread.join()
+        self._thread = None
+        units = self.layout.units()
+        if units:
+            self.ds.unwatch_s88(units)
+
+    # 進路 route_name を列車 train (機関車アドレスなど) のために予約して、ポイントを切り替える。
+    # 予約できるまで最大 timeout 秒待つ (0 なら待たない)。予約できなければ None。
+    def reserve(self, route_name, train, timeout = 60):
+        route = self.layout.routes[route_name]
+        deadline = time.monotonic() + timeout
+        with self._cv:
+            while not self._available(route, train):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.info("LAYOUT RESERVE_TIMEOUT %s train=%r", route.name, train)
+                    return None
+                self._cv.wait(remaining)
+            r = Reservation(route, train)
+            for name in route.blocks:
+                old = self._owner.get(name)
+                if old is not None:             # 同じ列車が持っている閉塞 (今いる閉塞) を引き継ぐ
+                    self._drop_block(old, name)
+                self._owner[name] = r
+            for name in route.blocks:
+                if self.layout.occupied(name, self.ds.s88b):
+                    self._enter(r, name, time.monotonic())
+            for addr, dir in route.turnouts.items():
+                lock = self._turnout_lock.get(addr)
+                if lock is not None and lock[0] != dir:     # 同じ列車の前の予約の向きから変える
+                    for old in list(lock[1]):
+                        self._unlock_turnout(old, addr)
+                self._turnout_lock.setdefault(addr, (dir, set()))[1].add(r)
+        log.info("LAYOUT RESERVED %s train=%r", route.name, train)
+        # ポイントはまとめて積んで、全部の応答を待つ。
+        futures = [self.ds.setTurnout(addr, dir, wait = False) for addr, dir in route.turnouts.items()]
+        failed = [rcv for rcv in (f.result() for f in futures) if rcv is not None and '200 Ok' not in rcv]
+        if failed:
+            log.error("LAYOUT TURNOUT_FAILED %s %r", route.name, failed)
+            self.release(r)
+            return None
+        return r
+
+    # 予約の残りを全部解放する。
+    def release(self, reservation):
+        with self._cv:
+            for name in list(reservation.blocks):
+                self._drop_block(reservation, name)
+            self._finish(reservation)
+            self._cv.notify_all()
+
+    # 閉塞の名前 -> 予約している列車。
+    def owners(self):
+        with self._cv:
+            return {name: r.train for name, r in self._owner.items()}
+
+    def _available(self, route, train):
+        for i, name in enumerate(route.blocks):
+            owner = self._owner.get(name)
+            if owner is not None and owner.train != train:
+                return False
+            if owner is None and i > 0 and self.layout.occupied(name, self.ds.s88b):
+                return False                    # 予約していない列車がいる
+        for addr, dir in route.turnouts.items():
+            lock = self._turnout_lock.get(addr)
+            if lock is not None and lock[0] != dir and any(r.train != train for r in lock[1]):
+                return False
+        return True
+
+    def _drop_block(self, r, name):
+        if name not in r.blocks:
+            return
+        r.blocks.remove(name)
+        if self._owner.get(name) is r:
+            del self._owner[name]
+        for addr in self.layout.blocks[name].turnouts:
+            if addr in r.turnouts:
+                self._unlock_turnout(r, addr)
+        if not r.blocks:
+            self._finish(r)
+
+    def _unlock_turnout(self, r, addr):
+        del r.turnouts[addr]
+        lock = self._turnout_lock.get(addr)
+        if lock is not None:
+            lock[1].discard(r)
+            if not lock[1]:
+                del self._turnout_lock[addr]
+
+    def _finish(self, r):
+        for addr in list(r.turnouts):
+            self._unlock_turnout(r, addr)
+        if not r.released:
+            log.info("LAYOUT RELEASED %s train=%r", r.route.name, r.train)
+        r._released.set()
+
+    def _edge_loop(self):
+        for edge in self._sub:
+            block = self.layout.block_of(edge.count, edge.num)
+            with self._cv:
+                bit = (edge.count, edge.num)
+                if edge.value:
+                    self._bits.add(bit)
+                else:
+                    self._bits.discard(bit)
+                if block is None:
+                    continue
+                r = self._owner.get(block.name)
+                if r is None:
+                    if edge.value:
+                        log.warning("LAYOUT UNRESERVED_OCCUPANCY %s S88-%d bit %d", block.name, edge.count, edge.num)
+                    else:
+                        self._cv.notify_all()       # 予約していない列車がいなくなったかもしれない
+                    continue
+                if edge.value:
+                    self._enter(r, block.name, edge.time)
+                self._sweep(r)
+
+    def _enter(self, r, name, t):
+        r.entered.add(name)
+        if name == r.route.blocks[-1] and r.arrived_at is None:
+            r.arrived_at = t
+            r._arrived.set()
+
+    # 列車が入った一番先の閉塞より手前で、センサが全部 L の閉塞は通り過ぎたので解放する。
+    def _sweep(self, r):
+        ahead = max([r.route.blocks.index(name) for name in r.entered], default = -1)
+        for name in r.route.blocks[:max(0, ahead)]:
+            if name in r.blocks and not any(b in self._bits for b in self.layout.blocks[name].sensors):
+                self._drop_block(r, name)
+                log.debug("LAYOUT CLEARED %s train=%r", name, r.train)
+                self._cv.notify_all()
@@ -0,0 +1,254 @@
+'''
+desktopstation_momentum.py
+Description: 機関車の速度を、目標の速度まで加速・減速の曲線に沿って少しずつ変えるためのものです。
+setLocoSpeed で速度を一度に変える代わりに目標の速度を渡すと、1本のスレッドが全部の機関車の今の速度を計算して、
+シリアルの帯域(budget)の分だけ速度のコマンドを送ります。送る回数は動いている機関車で順番に分けるので、
+何両動かしても速度のコマンドがキューにあふれて S88 のポーリングや他の列車のコマンドを待たせることはありません。
+目標の速度に着いたら、その値は必ず送ります。(途中の値は間引くことがあります)
+
+加速・減速の曲線は、1秒あたりに変える速度の量で指定します。
+    数          いつも同じ割合 (例: 200 なら 0 から 1000 まで 5 秒)
+    [(速度, 量), ...]   今の速度での量を、表の間をつないで決める (例: [(0, 300), (600, 100)] は低速ほどよく加速する)
+    None        すぐに目標の速度にする
+
+使い方:
+    m = Momentum(ds)
+    m.start()
+    m.set_curve(33, accel = 150, brake = 300)
+    m.set_target(33, 550)               # 550 までゆっくり加速する (すぐ戻る)
+    ds.waitForS88(1, 5)
+    m.set_target(33, 0)                 # 300 ずつ減速して止まる
+    m.wait_reached(33)
+    m.stop()
+'''
+
+import time, bisect, logging, threading
+
+log = logging.getLogger('desktopstation.momentum')
+
+# 曲線 curve の、今の速度 speed での1秒あたりの変化量。None ならすぐに変える。
+def _rate(curve, speed):
+    if curve is None or isinstance(curve, (int, float)):
+        return curve
+    speeds = [s for s, _ in curve]
+    i = bisect.bisect_right(speeds, speed)
+    if i == 0:
+        return curve[0][1]
+    if i == len(curve):
+        return curve[-1][1]
+    (s0, r0), (s1, r1) = curve[i - 1], curve[i]
+    return r0 + (r1 - r0) * (speed - s0) / (s1 - s0)
+
+# 機関車1両分。speed は計算上の今の速度、sent は最後に受け付けられた (200 Ok の) 速度。
+class _Loco:
+    def __init__(self, addr, accel, brake):
+        self.addr = addr
+        self.accel = accel
+        self.brake = brake
+        self.speed = 0.0
+        self.target = 0
+        self.sent = None
+        self.future = None              # 最後に送った setLocoSpeed の future
+        self.pending = None             # 応答を待っている速度
+
+    # 応答を待っているコマンドがあるか。
+    def busy(self):
+        return self.future is not None and not self.future.done()
+
+    def moving(self):
+        return self.speed != self.target or self.sent != self.target
+
+class Momentum:
+    # accel, brake は set_curve しなかった機関車の曲線。budget は速度のコマンドに使う帯域の割合
+    # (Pacing の 'loco' の間隔で送れる数に対して)。tick は速度を計算し直す間隔(秒)。
+    def __init__(self, ds, accel = 200, brake = 300, budget = 0.5, tick = 0.05):
+        self.ds = ds
+        self.accel = accel
+        self.brake = brake
+        self.budget = budget
+        self.tick = tick
+        self.locos = {}                 # アドレス -> _Loco
+        self.updates = 0                # 送った速度のコマンドの数
+        self._cv = threading.Condition()
+        self._order = []                # 次に送る順番 (アドレス)
+        self._stalled = set()           # DS につながっていないので送るのを止めている機関車 (アドレス)
+        self._tokens = 0.0              # 今送ってよいコマンドの数
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="DS-MOMENTUM", daemon=True)
+        self._thread.start()
+
+    # スレッドを止める。目標の速度をまだ送っていない機関車には、目標の速度を送って届くまで待つ。
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._cv:
+            self._running = False
+            self._cv.notify_all()
+        self._thread.join()
+        self._thread = None
+        with self._cv:
+            for loco in self.locos.values():
+                if loco.sent != loco.target and not (loco.busy() and loco.pending == loco.target):
+                    loco.speed = loco.target
+                    self._send(loco)
+            self._order = []
+            futures = [loco.future for loco in self.locos.values() if loco.future is not None]
+        for f in futures:
+            f.result()
+
+    def _loco(self, addr):
+        loco = self.locos.get(addr)
+        if loco is None:
+            loco = self.locos[addr] = _Loco(addr, self.accel, self.brake)
+        return loco
+
+    # 機関車 addr の加速・減速の曲線を決める。brake を省略すると accel と同じ。
+    def set_curve(self, addr, accel, brake = None):
+        with self._cv:
+            loco = self._loco(addr)
+            loco.accel = accel
+            loco.brake = accel if brake is None else brake
+
+    # 機関車 addr の目標の速度を決める。accel, brake を指定すると、この目標に向かうときだけその曲線を使う。
+    def set_target(self, addr, speed, accel = None, brake = None):
+        with self._cv:
+            loco = self._loco(addr)
+            if accel is not None or brake is not None:
+                loco.accel = loco.accel if accel is None else accel
+                loco.brake = loco.brake if brake is None else brake
+            loco.target = int(round(speed))    # 送るのは整数なので、目標も整数にしないと着かない
+            if addr not in self._order:
+                self._order.append(addr)
+            self._cv.notify_all()
+
+    # すぐに止める。(曲線を使わず、停車のコマンドを優先して送る)
+    def emergency_stop(self, addr):
+        with self._cv:
+            loco = self._loco(addr)
+            loco.speed = loco.target = 0
+            if addr in self._order:
+                self._order.remove(addr)
+            self._send(loco, force = True)
+            self._cv.notify_all()
+
+    # 計算上の今の速度。
+    def speed(self, addr):
+        with self._cv:
+            return self._loco(addr).speed
+
+    # 目標の速度が受け付けられるまで待つ。受け付けられたら True。
+    def wait_reached(self, addr, timeout = None):
+        with self._cv:
+            loco = self._loco(addr)
+            self._cv.wait_for(lambda: not loco.moving() or not self._running, timeout)
+            return not loco.moving()
+
+    # 1秒あたりに送ってよい速度のコマンドの数。
+    def _rate_limit(self):
+        gap = self.ds.pacing.gap.get('loco') or 0.1
+        return self.budget / gap
+
+    def _loop(self):
+        last = time.monotonic()
+        with self._cv:
+            while self._running:
+                if self._stalled and self.ds.comm_ok:
+                    log.info("MOMENTUM RESUMED (%d locos)", len(self._stalled))
+                    self._order += [a for a in self._stalled if a not in self._order]
+                    self._stalled.clear()
+                if not self._order:
+                    self._tokens = 0.0
+                    self._cv.wait(1.0 if self._stalled else None)     # つながり直すのを見るため
+                    last = time.monotonic()
+                    continue
+                self._cv.wait(self.tick)
+                now = time.monotonic()
+                dt, last = now - last, now
+                if not self.ds.comm_ok:     # つながっていない間は送らずに止めておく
+                    self._stall(self._order)
+                    self._order = []
+                    continue
+                limit = self._rate_limit()
+                self._tokens = min(self._tokens + limit * dt, max(1.0, len(self._order)))
+                self._step(dt)
+                self._emit()
+                self._cv.notify_all()       # wait_reached を起こす
+
+    # 全部の機関車の今の速度を dt 秒分進める。
+    def _step(self, dt):
+        for addr in self._order:
+            loco = self.locos[addr]
+            if loco.speed == loco.target:
+                continue
+            speeding_up = abs(loco.target) > abs(loco.speed)
+            rate = _rate(loco.accel if speeding_up else loco.brake, abs(loco.speed))
+            if rate is None or rate <= 0:
+                loco.speed = loco.target
+                continue
+            delta = rate * dt
+            if abs(loco.target - loco.speed) <= delta:
+                loco.speed = loco.target
+            else:
+                loco.speed += delta if loco.target > loco.speed else -delta
+
+    # 帯域の分だけ、動いている機関車に順番に今の速度を送る。
+    # 目標に着いた機関車を先に送り、途中の値は前に送ったコマンドの応答が来ているときだけ送る。
+    def _emit(self):
+        finals = [a for a in self._order if self.locos[a].speed == self.locos[a].target]
+        ramps = [a for a in self._order if a not in finals]
+        for addr in finals + ramps:
+            if self._tokens < 1.0:
+                break
+            loco = self.locos[addr]
+            value = int(round(loco.speed))
+            if value == loco.sent or (loco.busy() and (value == loco.pending or addr in ramps)):
+                continue
+            self._send(loco)
+            self._tokens -= 1.0
+            self._order.remove(addr)        # 送った機関車は順番の最後へ
+            self._order.append(addr)
+        for addr in [a for a in self._order if not self.locos[a].moving()]:
+            self._order.remove(addr)
+
+    # 今の速度を送る。sent は応答が来てから進めるので、失敗した目標の速度は次の回に送り直される。
+    def _send(self, loco, force = False):
+        value = int(round(loco.speed))
+        future = loco.future = self.ds.setLocoSpeed(loco.addr, value, wait = False, force = force)
+        loco.pending = value
+        self.updates += 1
+        log.debug("MOMENTUM %d -> %d (target %d)", loco.addr, value, loco.target)
+        future.add_done_callback(lambda f: self._on_reply(loco, value, f))
+
+    # addrs の機関車を、DS につながるまで送らないようにする。
+    def _stall(self, addrs):
+        if not self._stalled:
+            log.warning("MOMENTUM PAUSED (not connected)")
+        self._stalled.update(addrs)
+
+    def _on_reply(self, loco, value, future):
+        try:
+            rcv = future.result()
+            ok = rcv.ok if rcv else (rcv is None and self.ds.comm_ok)    # None は状態が同じなので送らなかった
+        except Exception:
+            ok = False
+        with self._cv:
+            if ok:
+                loco.sent = value
+            else:
+                if loco.sent == value:
+                    loco.sent = None
+                if not self.ds.comm_ok:
+                    self._stall([loco.addr])            # つながったら送り直す
+                    if loco.addr in self._order:
+                        self._order.remove(loco.addr)
+                else:
+                    log.warning("MOMENTUM SEND_FAILED %d -> %d", loco.addr, value)
+                    if loco.addr not in self._order and self._running:
+                        self._order.append(loco.addr)     # 目標の速度なら送り直す
+            self._cv.notify_all()
@@ -0,0 +1,180 @@
+'''
+desktopstation_multi.py
+Description: 複数の DesktopStation (コマンドステーション) を1つのように扱うためのものです。
+大きなレイアウトを複数の DesktopStation とブースターに分けたときに使います。
+機関車とポイントのアドレスは、アドレスの表 (どの装置の何番か) で担当の装置に送ります。
+装置ごとに別々の送受信スレッドとシリアルポートを使うので、装置を増やすとコマンドの処理量も増えます。
+S88 は、追加した順に装置ごとの S88 装置の番号をつないだ1つの番号で読めます。
+(1台目に S88 装置が2つあれば、2台目の1つ目の S88 装置は3番)
+
+使い方:
+    ms = MultiStation()
+    ms.add_station('east', 'COM3', s88_count = 2, locos = range(1, 50), turnouts = range(1, 9))
+    ms.add_station('west', 'COM4', s88_count = 1, locos = {70: 3}, turnouts = {9: 1, 10: 2})
+    ms.open()
+    ms.setPower(1)
+    ms.setLocoSpeed(70, 400)        # west の機関車 3 番に送る
+    ms.waitForS88(3, 1)             # west の1つ目の S88 装置の1番
+    ms.close()
+'''
+
+import threading
+import desktopstation
+from desktopstation import S88EdgeBuffer, log
+
+# アドレスの表を {全体のアドレス: 装置でのアドレス} にする。数の並び (range など) なら同じ番号。
+def _address_map(spec):
+    if spec is None:
+        return {}
+    if isinstance(spec, dict):
+        return dict(spec)
+    return {a: a for a in spec}
+
+class MultiStation:
+    def __init__(self):
+        self.stations = {}              # 名前 -> DesktopStation
+        self.ports = {}                 # 名前 -> シリアルポート
+        self.locos = {}                 # 全体の機関車アドレス -> (名前, 装置でのアドレス)
+        self.turnouts = {}              # 全体のポイント番号 -> (名前, 装置での番号)
+        self.default = None             # 表に無いアドレスを送る装置の名前
+        self._units = []                # 全体の S88 装置番号 - 1 -> (名前, 装置での番号)
+        self._offset = {}               # 名前 -> その装置の S88 の全体での番号のずれ
+        self._edge_lock = threading.Lock()
+        self.s88_edges = S88EdgeBuffer()    # 全部の装置の S88 の変化 (装置番号は全体の番号)
+
+    # 装置を追加する。locos, turnouts はその装置が担当するアドレスの表 (範囲か辞書)。
+    # default = True なら表に無いアドレスもこの装置に送る。それ以外の引数は DesktopStation に渡す。
+    def add_station(self, name, port, s88_count = 1, locos = None, turnouts = None, default = False, **kwargs):
+        if name in self.stations:
+            raise ValueError("station %r already added" % name)
+        ds = desktopstation.DesktopStation(s88_count, **kwargs)
+        self.stations[name] = ds
+        self.ports[name] = port
+        for addr, local in _address_map(locos).items():
+            self.locos[addr] = (name, local)
+        for addr, local in _address_map(turnouts).items():
+            self.turnouts[addr] = (name, local)
+        if default:
+            self.default = name
+        offset = self._offset[name] = len(self._units)
+        self._units += [(name, i + 1) for i in range(s88_count)]
+        ds.s88_hooks.append(lambda ds, now, old, new: self._merge_s88(offset, now, old, new))
+        return ds
+
+    # 全部の装置を同時に開く。全部開けたら True。引数 (reset, reconnect など) は DesktopStation.open に渡す。
+    def open(self, **kwargs):
+        results = {}
+        threads = [threading.Thread(target=lambda n=n: results.__setitem__(n, self.stations[n].open(self.ports[n], **kwargs)),
+                                    name="DS-OPEN-" + str(n)) for n in self.stations]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        for name, ok in results.items():
+            if not ok:
+                log.error("DS MULTI_OPEN_NG %s %s", name, self.ports[name])
+        return all(results.values())
+
+    def close(self):
+        for ds in self.stations.values():
+            ds.close()
+
+    def _station(self, table, addr, what):
+        entry = table.get(addr)
+        if entry is not None:
+            return self.stations[entry[0]], entry[1]
+        if self.default is not None:
+            return self.stations[self.default], addr
+        raise ValueError("%s %d is not mapped to any station" % (what, addr))
+
+    # 全部の装置に同じコマンドを積んで、全部の応答を {名前: 応答} で返す。
+    def _all(self, fn, wait):
+        futures = {name: fn(ds) for name, ds in self.stations.items()}
+        if not wait:
+            return futures
+        return {name: f.result() for name, f in futures.items()}
+
+    def setPing(self, wait = True):
+        return self._all(lambda ds: ds.setPing(wait = False), wait)
+
+    def setPower(self, on, wait = True):
+        return self._all(lambda ds: ds.setPower(on, wait = False), wait)
+
+    def setLocoSpeed(self, addr, speed, speed_step = 0, wait = True, force = False):
+        ds, local = self._station(self.locos, addr, "loco")
+        return ds.setLocoSpeed(local, speed, speed_step, wait = wait, force = force)
+
+    def setLocoDirection(self, addr, dir, wait = True, force = False):
+        ds, local = self._station(self.locos, addr, "loco")
+        return ds.setLocoDirection(local, dir, wait = wait, force = force)
+
+    def setLocoFunction(self, addr, num, on, wait = True, force = False):
+        ds, local = self._station(self.locos, addr, "loco")
+        return ds.setLocoFunction(local, num, on, wait = wait, force = force)
+
+    def setLocoConfig(self, addr, value, wait = True):
+        ds, local = self._station(self.locos, addr, "loco")
+        return ds.setLocoConfig(local, value, wait = wait)
+
+    def getLocoConfig(self, addr, num, wait = True):
+        ds, local = self._station(self.locos, addr, "loco")
+        return ds.getLocoConfig(local, num, wait = wait)
+
+    def setTurnout(self, addr, dir, wait = True, force = False):
+        ds, local = self._station(self.turnouts, addr, "turnout")
+        return ds.setTurnout(local, dir, wait = wait, force = force)
+
+    # 全体の S88 装置番号を (DesktopStation, 装置での番号) にする。
+    def s88_unit(self, count):
+        if not 1 <= count <= len(self._units):
+            raise ValueError("S88 unit %d does not exist" % count)
+        name, local = self._units[count - 1]
+        return self.stations[name], local
+
+    @property
+    def s88b(self):
+        return [self.stations[name].s88b[local - 1] for name, local in self._units]
+
+    def readS88b(self, count, num):
+        ds, local = self.s88_unit(count)
+        return ds.readS88b(local, num)
+
+    def waitForS88(self, count, num, timeout = 60, raise_on_timeout = False):
+        ds, local = self.s88_unit(count)
+        result = ds.waitForS88(local, num, timeout, raise_on_timeout)
+        result.count = count
+        return result
+
+    # 全部の装置の S88 を読んで、全部読めたら True。装置ごとのコマンドは並んで送られる。
+    def updateS88b(self):
+        futures = [(ds, ds.getS88Words(len(ds.s88b), wait = False)) for ds in self.stations.values()]
+        ok = True
+        for ds, f in futures:
+            words = f.result()
+            if words is None:
+                ok = False
+            else:
+                ds._publish_s88(words)
+        return ok
+
+    # 全部の装置の S88 の変化を、全体の装置番号で受け取る読み手を作る。
+    def subscribe_s88_edges(self):
+        return self.s88_edges.subscribe()
+
+    # 各装置の S88 を読んだスレッドから呼ばれる。装置番号をずらして全体の記録に書く。
+    def _merge_s88(self, offset, now, old, new):
+        pad = [0] * offset
+        with self._edge_lock:           # 書き手は1つずつ
+            self.s88_edges.push_diff(now, pad + list(old[:len(new)]), pad + list(new))
+
+    def start_polling_s88(self, interval = 0.1, idle_interval = None, heartbeat_interval = None):
+        for ds in self.stations.values():
+            ds.start_polling_s88(interval, idle_interval, heartbeat_interval)
+
+    def stop_polling_s88(self):
+        for ds in self.stations.values():
+            ds.stop_polling_s88()
+
+    # {名前: その装置の stats()}
+    def stats(self):
+        return {name: ds.stats() for name, ds in self.stations.items()}
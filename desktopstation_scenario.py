@@ -0,0 +1,258 @@
+'''
+desktopstation_scenario.py
+Description: 列車の動き(出発、減速センサ、停止センサ、停車時間、ポイントの切り替え、ホーン)を書いた
+ダイヤ(シナリオ)のファイルを読んで、1つのイベントループで実行します。
+サンプルプログラムのように列車ごと・周回ごとにスレッドを作らないので、列車を増やしてもスレッドは増えません。
+S88 の変化は ds.subscribe_s88_edges() の記録から受け取り、コマンドは wait = False で積んだ結果を待ちます。
+周回ごとの時間は runs と stats() で確認できます。
+
+ダイヤの形 (JSON、または Python 3.11 以降なら TOML):
+    {
+      "trains": {
+        "rapid": {"addr": 33, "speed": 550, "slow": 200, "horn": "horn2.mp3",
+                  "setup": [{"speed": 0, "function": [0, 1], "direction": 2}],
+                  "steps": [{"turnouts": {"1": 0}, "speed": "speed"},
+                            {"at": 1, "speed": "slow"},
+                            {"at": 2, "speed": 0, "dwell": 3}]},
+        ...
+      },
+      "runs": 0,                                    # 周回の数。0 なら止めるまで
+      "between_runs": {"horn": "stationbell1.mp3"}  # 周回の間に行うこと
+    }
+
+1つの step は次の順に行います (書いたものだけ):
+    after       秒数だけ待つ
+    at          センサ (ビット番号か [装置番号, ビット番号]) が H になるまで待つ。timeout (既定 60 秒) を過ぎたら失敗
+    wait        "列車名.印" が付くまで待つ (他の列車の mark)
+    turnouts    {"ポイント番号": 向き} をまとめて切り替える
+    direction   進行方向 (1 or 2)
+    function    [ファンクション番号, 0/1]
+    speed       速度。数か、列車の "speed" / "slow"
+    horn        true なら列車の horn、文字列ならそのファイルを鳴らす (playsound があれば)
+    mark        この列車に印を付ける
+    dwell       秒数だけ待つ
+
+使い方:
+    python desktopstation_scenario.py example_scenario_overtake.json --port COM3
+'''
+
+import json, time, asyncio, logging, argparse
+import desktopstation
+from desktopstation import _s88_bit
+
+try:
+    import playsound            # playsound==1.2.2
+except ImportError:
+    playsound = None
+
+log = logging.getLogger('desktopstation.scenario')
+
+# ダイヤの間違いや、センサが来なかったときの例外。
+class ScenarioError(Exception):
+    pass
+
+# JSON か TOML のダイヤのファイルを読む。
+def load_scenario(path):
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            raise ScenarioError("TOML needs Python 3.11 or later (tomllib); use JSON instead")
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path, encoding = 'utf-8') as f:
+        return json.load(f)
+
+class ScenarioRunner:
+    # ds は open 済みの DesktopStation。ポーリングは ds.start_polling_s88 で別に行うこと。
+    def __init__(self, ds, scenario):
+        self.ds = ds
+        self.scenario = scenario
+        self.trains = scenario.get('trains', {})
+        for name, train in self.trains.items():
+            if 'addr' not in train:
+                raise ScenarioError("train %r has no addr" % name)
+        self.runs = []                  # 周回ごとの記録
+        self._last_rise = {}            # (装置番号, ビット番号) -> 最後に H になった時刻
+        self._sensor_waiters = {}       # (装置番号, ビット番号) -> H になるのを待っている future のリスト
+        self._marks = {}                # "列車名.印" -> asyncio.Event
+        self._loop = None
+
+    def run_forever(self, runs = None):
+        return asyncio.run(self.run(runs))
+
+    # ダイヤを runs 回 (省略時はダイヤの "runs"、0 なら止めるまで) 実行する。
+    async def run(self, runs = None):
+        self._loop = asyncio.get_running_loop()
+        runs = self.scenario.get('runs', 1) if runs is None else runs
+        sub = self.ds.subscribe_s88_edges()
+        edges = self._loop.create_task(self._edge_task(sub))
+        try:
+            await asyncio.gather(*[self._run_steps(name, train.get('setup', []), time.monotonic())
+                                   for name, train in self.trains.items()])
+            n = 0
+            while not runs or n < runs:
+                n += 1
+                await self._run_once(n)
+                between = self.scenario.get('between_runs')
+                if between and (not runs or n < runs):
+                    await self._step(None, between, time.monotonic())
+        except BaseException:
+            self._stop_all()            # 途中で止めたか、1つの列車が失敗したら全部の列車を止める
+            raise
+        finally:
+            sub.close()
+            edges.cancel()
+        return self.runs
+
+    async def _run_once(self, n):
+        self._marks.clear()
+        start = time.monotonic()
+        record = {'run': n, 'start': start, 'trains': {}}
+        self.runs.append(record)
+        tasks = [self._loop.create_task(self._run_train(name, train, start, record))
+                 for name, train in self.trains.items()]
+        try:
+            # 1つの列車が失敗したら、他の列車も待たずに止める (mark を待っている列車は終わらないので)
+            done, pending = await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+        record['seconds'] = time.monotonic() - start
+        errors = [t.exception() for t in done if not t.cancelled() and t.exception() is not None]
+        log.info("SCENARIO RUN %d %.1f s", n, record['seconds'])
+        if errors:
+            record['error'] = str(errors[0])
+            raise errors[0]
+
+    async def _run_train(self, name, train, start, record):
+        stat = record['trains'][name] = {'seconds': None, 'at': []}
+        await self._run_steps(name, train.get('steps', []), start, stat)
+        stat['seconds'] = time.monotonic() - start
+
+    async def _run_steps(self, name, steps, start, stat = None):
+        since = start                   # この時刻以降にセンサが H になったら、その step に着いたことにする
+        for step in steps:
+            since = await self._step(name, step, since, start, stat)
+
+    async def _step(self, name, step, since, start = None, stat = None):
+        train = self.trains.get(name, {})
+        if 'after' in step:
+            await asyncio.sleep(step['after'])
+        if 'at' in step:
+            bit = _s88_bit(step['at'] if isinstance(step['at'], int) else tuple(step['at']))
+            t = await self._wait_sensor(bit, since, step.get('timeout', 60), name)
+            since = t
+            if stat is not None:
+                stat['at'].append((bit, t - start))
+        if 'wait' in step:
+            await self._mark(step['wait']).wait()
+        futures = []
+        for addr, dir in step.get('turnouts', {}).items():
+            futures.append(self.ds.setTurnout(int(addr), dir, wait = False))
+        if name is not None:
+            addr = train['addr']
+            if 'direction' in step:
+                futures.append(self.ds.setLocoDirection(addr, step['direction'], wait = False))
+            if 'function' in step:
+                futures.append(self.ds.setLocoFunction(addr, step['function'][0], step['function'][1], wait = False))
+            if 'speed' in step:
+                speed = step['speed']
+                if isinstance(speed, str):
+                    speed = train[speed]
+                futures.append(self.ds.setLocoSpeed(addr, speed, wait = False))
+        if futures:                     # まとめて積んだコマンドの応答を待つ
+            await asyncio.gather(*[asyncio.wrap_future(f) for f in futures])
+        if 'horn' in step:
+            self._horn(train.get('horn') if step['horn'] is True else step['horn'])
+        if 'mark' in step:
+            self._mark(name + '.' + step['mark']).set()
+        if 'dwell' in step:
+            await asyncio.sleep(step['dwell'])
+        return since
+
+    def _mark(self, key):
+        event = self._marks.get(key)
+        if event is None:
+            event = self._marks[key] = asyncio.Event()
+        return event
+
+    def _horn(self, file):
+        if not file:
+            return
+        if playsound is None:
+            log.info("SCENARIO HORN %s (playsound not installed)", file)
+            return
+        playsound.playsound(file, False)
+
+    # bit が H であるか、since 以降に H になっていれば、その時刻を返す。そうでなければ H になるまで待つ。
+    async def _wait_sensor(self, bit, since, timeout, name):
+        if self.ds.readS88b(*bit):
+            return time.monotonic()
+        if self._last_rise.get(bit, -1.0) >= since:
+            return self._last_rise[bit]
+        future = self._loop.create_future()
+        waiters = self._sensor_waiters.setdefault(bit, [])
+        waiters.append(future)
+        self.ds.watch_s88(bit[0])
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise ScenarioError("train %r: S88-%d bit %d not arrived in %.1f s" % ((name,) + bit + (timeout,)))
+        finally:
+            self.ds.unwatch_s88(bit[0])
+            if future in waiters:
+                waiters.remove(future)
+
+    async def _edge_task(self, sub):
+        async for edge in sub:
+            if not edge.value:
+                continue
+            bit = (edge.count, edge.num)
+            self._last_rise[bit] = edge.time
+            for future in self._sensor_waiters.pop(bit, []):
+                if not future.done():
+                    future.set_result(edge.time)
+
+    # 全部の停止コマンドを積んでから、届くまで待つ。(ループは止まってもよい)
+    def _stop_all(self):
+        futures = [self.ds.setLocoSpeed(train['addr'], 0, wait = False, force = True) for train in self.trains.values()]
+        for f in futures:
+            f.result()
+
+    # 列車ごとの1周の時間の統計。センサごとの時間は runs の 'at' にある。
+    def stats(self):
+        result = {}
+        for name in self.trains:
+            times = [r['trains'][name]['seconds'] for r in self.runs
+                     if name in r['trains'] and r['trains'][name]['seconds'] is not None]
+            result[name] = {'runs': len(times), 'mean': sum(times) / len(times) if times else None,
+                            'min': min(times, default = None), 'max': max(times, default = None)}
+        return result
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "run a DesktopStation timetable")
+    parser.add_argument('scenario', help = "JSON or TOML timetable")
+    parser.add_argument('--port', default = 'COM3')
+    parser.add_argument('--runs', type = int, default = None, help = "number of runs (0 = until Ctrl-C)")
+    parser.add_argument('--s88', type = int, default = 1, help = "number of S88 units")
+    parser.add_argument('--poll-interval', type = float, default = 0.1)
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO)
+    runner = ScenarioRunner(desktopstation.DesktopStation(opt.s88), load_scenario(opt.scenario))
+    ds = runner.ds
+    if ds.open(opt.port) == False:
+        return
+    ds.setPower(1)
+    ds.start_polling_s88(opt.poll_interval)
+    try:
+        runner.run_forever(opt.runs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ds.close()
+        print(json.dumps(runner.stats(), indent = 2))
+
+if __name__ == '__main__':
+    main()
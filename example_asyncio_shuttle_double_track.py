@@ -0,0 +1,60 @@
+'''
+Description: 
+desktopstation_async.py の動作確認用サンプルプログラムです。
+example_shuttle_threading_double_track.py と同じ動きを、スレッドを使わずに asyncio で行います。
+2つの列車がそれぞれ独立した線路を、S88の1と3の間、S88の4と6の間を往復します。
+1,4 に到着したときは、もう片方の列車が到着するまで待ちます。
+Ctrl-C で止めると、待っている列車のタスクはすべてキャンセルされます。
+'''
+
+
+import asyncio, playsound     # playsound==1.2.2
+import logging
+import desktopstation_async
+
+logging.basicConfig(level = logging.INFO)     # DEBUG にすると送受信したコマンドと S88 の状態も表示する
+
+ds = desktopstation_async.AsyncDesktopStation()
+
+DS_COMPORT = 'COM3'
+
+class Train:    # 各列車のパラメータを定義するクラス
+    def __init__(self, addr, speed, horn_file):
+        self.addr = addr
+        self.speed = speed
+        self.horn_file = horn_file
+
+tr1 = Train(10, 250, "horn1.mp3")
+tr2 = Train(70, 300, "horn2.mp3")
+
+async def train_move(train: Train, s88_dist, s88_station ):
+    await ds.setLocoFunction(train.addr,0, 1)           # ライトを点灯
+    await ds.setLocoDirection(train.addr, 2)            # 進行方向を前へ
+    await ds.setLocoSpeed(train.addr, train.speed)      # 前方に向かって出発
+    await ds.wait_for_s88(1, s88_dist)                  # 前方指定位置に到着待ち
+    await ds.setLocoSpeed(train.addr, 0)                # 前方指定位置に停車
+    await ds.setLocoDirection(train.addr, 1)            # 列車の方向転換
+    playsound.playsound(train.horn_file, False)         # ホーンを鳴らす（PC・非同期）
+    await asyncio.sleep(0.5)                            # ちょっと待つ
+    await ds.setLocoSpeed(train.addr, train.speed)      # 出発位置に向かって後進開始
+    await ds.wait_for_s88(1, s88_station)               # 出発位置に到着待ち
+    await ds.setLocoSpeed(train.addr, 0)                # 出発位置に停車
+    await asyncio.sleep(0.5)                            # ちょっと待つ
+
+async def main():
+    if await ds.open(DS_COMPORT) == False:
+        return
+    await ds.setPing()
+    await ds.setPower(1)
+    await ds.start_polling_s88()
+    try :
+        while True:
+            await asyncio.gather(train_move(tr1, 3, 1), train_move(tr2, 6, 4))     # ここで2つの列車が揃っている。
+    finally:
+        await ds.close()
+
+try :
+    asyncio.run(main())
+
+except KeyboardInterrupt:
+    pass
@@ -12,8 +12,11 @@ Date: 2024/1/2 初版
 
 
 import time, threading, ctypes, playsound     # playsound==1.2.2
+import logging
 import desktopstation
 
+logging.basicConfig(level = logging.INFO)     # DEBUG にすると送受信したコマンドと S88 の状態も表示する
+
 ds = desktopstation.DesktopStation()
 
 DS_COMPORT = 'COM3'
@@ -39,10 +42,11 @@ class S88:
     turnout_change_index = 5
     late_train_start_index = 3
 
-# 終了時に呼ばれてスレッドをすべて終了する
+# 終了時に呼ばれて列車のスレッドをすべて終了する
+# (DesktopStation の DS-IO, DS-RX, DS-S88 などは止めない。止めると ds.close() で電源を切れなくなる)
 def kill_all_threads():
   for thread in threading.enumerate():
-    if thread != threading.main_thread():
+    if thread != threading.main_thread() and not thread.daemon and not thread.name.startswith("DS-"):
       print(f"kill: {thread.name}")
       ctypes.pythonapi.PyThreadState_SetAsyncExc(thread.native_id, ctypes.py_object(SystemExit))
 
@@ -11,8 +11,11 @@ Date: 2024/6/8 初版
 
 
 import time, threading, ctypes, playsound     # playsound==1.2.2
+import logging
 import desktopstation
 
+logging.basicConfig(level = logging.INFO)     # DEBUG にすると送受信したコマンドと S88 の状態も表示する
+
 ds = desktopstation.DesktopStation()
 
 DS_COMPORT = 'COM3'
@@ -37,10 +40,11 @@ class S88:
     t0_thuru = 6        # tr2 が 6 に入る前に tr1 が 1 を抜けていて、かつ
     t1_thuru = 5        # tr2 が 1 に入る前に tr1 が 2 を抜けている条件
 
-# 終了時に呼ばれてスレッドをすべて終了する
+# 終了時に呼ばれて列車のスレッドをすべて終了する
+# (DesktopStation の DS-IO, DS-RX, DS-S88 などは止めない。止めると ds.close() で電源を切れなくなる)
 def kill_all_threads():
   for thread in threading.enumerate():
-    if thread != threading.main_thread():
+    if thread != threading.main_thread() and not thread.daemon and not thread.name.startswith("DS-"):
       print(f"kill: {thread.name}")
       ctypes.pythonapi.PyThreadState_SetAsyncExc(thread.native_id, ctypes.py_object(SystemExit))
 
@@ -9,8 +9,11 @@ Date: 2023/12/28 初版
 
 
 import time, playsound      # playsound==1.2.2
+import logging
 import desktopstation
 
+logging.basicConfig(level = logging.INFO)     # DEBUG にすると送受信したコマンドと S88 の状態も表示する
+
 ds = desktopstation.DesktopStation()
 
 DS_COMPORT = 'COM3'
@@ -11,8 +11,11 @@ Date: 2023/12/28 初版
 
 
 import time, threading, ctypes, playsound     # playsound==1.2.2
+import logging
 import desktopstation
 
+logging.basicConfig(level = logging.INFO)     # DEBUG にすると送受信したコマンドと S88 の状態も表示する
+
 ds = desktopstation.DesktopStation()
 
 DS_COMPORT = 'COM3'
@@ -26,10 +29,11 @@ class Train:    # 各列車のパラメータを定義するクラス
 tr1 = Train(10, 250, "horn1.mp3")
 tr2 = Train(70, 300, "horn2.mp3")
 
-# 終了時に呼ばれてスレッドをすべて終了する
+# 終了時に呼ばれて列車のスレッドをすべて終了する
+# (DesktopStation の DS-IO, DS-RX, DS-S88 などは止めない。止めると ds.close() で電源を切れなくなる)
 def kill_all_threads():
   for thread in threading.enumerate():
-    if thread != threading.main_thread():
+    if thread != threading.main_thread() and not thread.daemon and not thread.name.startswith("DS-"):
       print(f"kill: {thread.name}")
       ctypes.pythonapi.PyThreadState_SetAsyncExc(thread.native_id, ctypes.py_object(SystemExit))
 